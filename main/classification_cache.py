@@ -0,0 +1,287 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from near_duplicates import (
+    NEAR_DUPLICATE_DRAFT_THRESHOLD, NEAR_DUPLICATE_ENABLED, NEAR_DUPLICATE_THRESHOLD, band_keys,
+    group_near_duplicates, message_signature, pack, record as record_near_duplicates, similarity, unpack
+)
+
+# SQLite file holding classification verdicts and thread reply state between runs
+CACHE_DB = os.getenv("CLASSIFICATION_CACHE_DB", "classification_cache.db")
+# verdicts older than this are dropped (default 14 days, longer than the 2-7 day window)
+CACHE_TTL_SECONDS = int(os.getenv("CLASSIFICATION_CACHE_TTL_SECONDS", 14 * 24 * 3600))
+# maximum number of verdicts kept; the oldest are evicted first
+CACHE_MAX_ENTRIES = int(os.getenv("CLASSIFICATION_CACHE_MAX_ENTRIES", 50000))
+# threads without a reply are looked up again after this long; replies, once seen, are kept
+REPLY_CACHE_TTL_SECONDS = int(os.getenv("REPLY_CACHE_TTL_SECONDS", 3600))
+# maximum number of near-duplicate signatures kept; the least recently matched are evicted first
+NEAR_DUPLICATE_MAX_ENTRIES = int(os.getenv("NEAR_DUPLICATE_MAX_ENTRIES", 5000))
+# stored signatures compared per lookup, most recently matched first
+NEAR_DUPLICATE_MAX_CANDIDATES = 50
+
+# the connection is shared by pipeline workers, so access is serialised
+lock = threading.Lock()
+
+def open_cache(path=CACHE_DB):
+    # open (or create) the cache database
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS verdicts ("
+        " message_id TEXT NOT NULL,"
+        " body_hash TEXT NOT NULL,"
+        " is_proposal INTEGER NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " PRIMARY KEY (message_id, body_hash))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS verdicts_created_at ON verdicts (created_at)")
+    # time of the latest reply in each thread (NULL if none), as of checked_at
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS thread_replies ("
+        " provider TEXT NOT NULL,"
+        " thread_id TEXT NOT NULL,"
+        " last_reply_at REAL,"
+        " checked_at REAL NOT NULL,"
+        " PRIMARY KEY (provider, thread_id))"
+    )
+    # when each recipient was last followed up, for the per-recipient cooldown
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS follow_ups ("
+        " provider TEXT NOT NULL,"
+        " recipient TEXT NOT NULL,"
+        " sent_at REAL NOT NULL,"
+        " PRIMARY KEY (provider, recipient))"
+    )
+    # MinHash signatures of classified bodies with their verdict and, once generated, follow-up draft
+    # and the recipient it was written for
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS near_duplicates ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " signature BLOB NOT NULL,"
+        " is_proposal INTEGER NOT NULL,"
+        " draft TEXT,"
+        " recipient TEXT,"
+        " used_at REAL NOT NULL)"
+    )
+    # databases from before drafts were tied to a recipient; their drafts are never reused
+    if "recipient" not in {row[1] for row in conn.execute("PRAGMA table_info(near_duplicates)")}:
+        conn.execute("ALTER TABLE near_duplicates ADD COLUMN recipient TEXT")
+    # LSH buckets of each signature
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS near_duplicate_bands ("
+        " bucket INTEGER NOT NULL,"
+        " entry_id INTEGER NOT NULL,"
+        " PRIMARY KEY (bucket, entry_id))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS near_duplicates_used_at ON near_duplicates (used_at)")
+    # drop stale entries once per run
+    evict(conn)
+    return conn
+
+def hash_body(body):
+    # hash of the email body, so edited messages are re-classified
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+def get_verdict(conn, message_id, body):
+    # return the cached verdict, or None if the message hasn't been seen
+    with lock:
+        row = conn.execute(
+            "SELECT is_proposal FROM verdicts WHERE message_id = ? AND body_hash = ? AND created_at >= ?",
+            (message_id, hash_body(body), time.time() - CACHE_TTL_SECONDS)
+        ).fetchone()
+    return bool(row[0]) if row else None
+
+def put_verdicts(conn, verdicts):
+    # store (message_id, body, is_proposal) verdicts in one transaction; each commit costs an fsync
+    now = time.time()
+    with lock:
+        conn.executemany(
+            "INSERT OR REPLACE INTO verdicts (message_id, body_hash, is_proposal, created_at) VALUES (?, ?, ?, ?)",
+            [(message_id, hash_body(body), int(is_proposal), now) for message_id, body, is_proposal in verdicts]
+        )
+        conn.commit()
+
+def evict(conn, ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES,
+          max_near_duplicates=NEAR_DUPLICATE_MAX_ENTRIES):
+    # remove expired verdicts
+    conn.execute("DELETE FROM verdicts WHERE created_at < ?", (time.time() - ttl_seconds,))
+    conn.execute("DELETE FROM thread_replies WHERE checked_at < ?", (time.time() - ttl_seconds,))
+    conn.execute("DELETE FROM follow_ups WHERE sent_at < ?", (time.time() - ttl_seconds,))
+    # enforce the size cap by removing the oldest verdicts
+    conn.execute(
+        "DELETE FROM verdicts WHERE rowid IN ("
+        " SELECT rowid FROM verdicts ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+        (max_entries,)
+    )
+    # near-duplicate signatures: expire the unused, cap the rest, then drop their buckets
+    conn.execute("DELETE FROM near_duplicates WHERE used_at < ?", (time.time() - ttl_seconds,))
+    conn.execute(
+        "DELETE FROM near_duplicates WHERE id IN ("
+        " SELECT id FROM near_duplicates ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+        (max_near_duplicates,)
+    )
+    conn.execute("DELETE FROM near_duplicate_bands WHERE entry_id NOT IN (SELECT id FROM near_duplicates)")
+    conn.commit()
+
+def get_thread_replies(conn, provider, thread_ids):
+    # return {thread_id: (last_reply_at, checked_at)} for the threads seen before
+    result = {}
+    with lock:
+        # stay well under SQLite's limit on query parameters
+        for start in range(0, len(thread_ids), 500):
+            chunk = thread_ids[start:start + 500]
+            rows = conn.execute(
+                f"SELECT thread_id, last_reply_at, checked_at FROM thread_replies"
+                f" WHERE provider = ? AND thread_id IN ({','.join('?' * len(chunk))})",
+                [provider, *chunk]
+            )
+            for thread_id, last_reply_at, checked_at in rows:
+                result[thread_id] = (last_reply_at, checked_at)
+    return result
+
+def put_thread_replies(conn, provider, replies):
+    # store {thread_id: last_reply_at or None} in one transaction
+    now = time.time()
+    with lock:
+        conn.executemany(
+            "INSERT OR REPLACE INTO thread_replies (provider, thread_id, last_reply_at, checked_at) VALUES (?, ?, ?, ?)",
+            [(provider, thread_id, last_reply_at, now) for thread_id, last_reply_at in replies.items()]
+        )
+        conn.commit()
+
+def get_recent_follow_ups(conn, provider, recipients, since):
+    # return the recipients followed up at or after the `since` epoch timestamp
+    result = set()
+    with lock:
+        for start in range(0, len(recipients), 500):
+            chunk = recipients[start:start + 500]
+            rows = conn.execute(
+                f"SELECT recipient FROM follow_ups"
+                f" WHERE provider = ? AND sent_at >= ? AND recipient IN ({','.join('?' * len(chunk))})",
+                [provider, since, *chunk]
+            )
+            result.update(recipient for (recipient,) in rows)
+    return result
+
+def put_follow_ups(conn, provider, recipients):
+    # record that the recipients were just followed up, in one transaction
+    now = time.time()
+    with lock:
+        conn.executemany(
+            "INSERT OR REPLACE INTO follow_ups (provider, recipient, sent_at) VALUES (?, ?, ?)",
+            [(provider, recipient, now) for recipient in recipients]
+        )
+        conn.commit()
+
+def find_near_duplicates(conn, signatures, threshold, recipients=None):
+    # best stored match at or above the threshold for each signature: (entry_id, is_proposal, draft) or None;
+    # with recipients, only entries holding a draft written for the same recipient match
+    matches = []
+    with lock:
+        for n, sig in enumerate(signatures):
+            best = None
+            if sig is not None:
+                keys = band_keys(sig)
+                rows = conn.execute(
+                    f"SELECT id, signature, is_proposal, draft FROM near_duplicates WHERE id IN ("
+                    f" SELECT entry_id FROM near_duplicate_bands WHERE bucket IN ({','.join('?' * len(keys))}))"
+                    f"{' AND draft IS NOT NULL AND recipient = ?' if recipients else ''} ORDER BY used_at DESC LIMIT ?",
+                    [*keys, *([recipients[n]] if recipients else []), NEAR_DUPLICATE_MAX_CANDIDATES]
+                )
+                best_score = threshold
+                for entry_id, blob, is_proposal, draft in rows:
+                    score = similarity(sig, unpack(blob))
+                    if score >= best_score:
+                        best, best_score = (entry_id, bool(is_proposal), draft), score
+            matches.append(best)
+        # matched entries are kept longest
+        touched = [(time.time(), match[0]) for match in matches if match]
+        if touched:
+            conn.executemany("UPDATE near_duplicates SET used_at = ? WHERE id = ?", touched)
+            conn.commit()
+    return matches
+
+def put_near_duplicates(conn, entries):
+    # store (signature, is_proposal, draft, recipient) entries in one transaction; returns their ids
+    now = time.time()
+    ids = []
+    with lock:
+        for sig, is_proposal, draft, recipient in entries:
+            entry_id = conn.execute(
+                "INSERT INTO near_duplicates (signature, is_proposal, draft, recipient, used_at) VALUES (?, ?, ?, ?, ?)",
+                (pack(sig), int(is_proposal), draft, recipient, now)
+            ).lastrowid
+            conn.executemany(
+                "INSERT OR IGNORE INTO near_duplicate_bands (bucket, entry_id) VALUES (?, ?)",
+                [(key, entry_id) for key in band_keys(sig)]
+            )
+            ids.append(entry_id)
+        conn.commit()
+    return ids
+
+def set_near_duplicate_drafts(conn, drafts):
+    # attach (entry_id, draft, recipient) follow-up drafts to stored signatures
+    with lock:
+        conn.executemany(
+            "UPDATE near_duplicates SET draft = ?, recipient = ? WHERE id = ?",
+            [(draft, recipient, entry_id) for entry_id, draft, recipient in drafts]
+        )
+        conn.commit()
+
+def reuse_near_duplicates(messages, known, threshold, produce, groups=None):
+    # fill in results for messages without a `known` one: near-duplicates within the list (and the same
+    # group, if given) share the result produced for the first of them; returns (results, indexes of those first messages)
+    results = list(known)
+    misses = [i for i, result in enumerate(results) if result is None]
+    leaders = group_near_duplicates(
+        [message_signature(messages[i]) for i in misses], threshold, groups and [groups[i] for i in misses]
+    )
+    firsts = [misses[k] for k, leader in enumerate(leaders) if leader == k]
+    if firsts:
+        for i, result in zip(firsts, produce([messages[i] for i in firsts])):
+            results[i] = result
+    for k, leader in enumerate(leaders):
+        results[misses[k]] = results[misses[leader]]
+    return results, firsts
+
+def classify_near_duplicates(conn, messages, classify_all, threshold=NEAR_DUPLICATE_THRESHOLD):
+    # reuse verdicts of stored or same-batch near-duplicates, sending one email per new template to `classify_all`
+    matches = find_near_duplicates(conn, [message_signature(m) for m in messages], threshold)
+    verdicts, firsts = reuse_near_duplicates(messages, [match and match[1] for match in matches], threshold, classify_all)
+    new = [i for i in firsts if message_signature(messages[i]) is not None]
+    for i, entry_id in zip(new, put_near_duplicates(conn, [(message_signature(messages[i]), verdicts[i], None, None) for i in new])):
+        messages[i]["near_duplicate_id"] = entry_id
+    record_near_duplicates("verdict", len(messages), len(messages) - len(firsts))
+    return verdicts
+
+def near_duplicate_drafts(conn, messages, recipients, generate_all, threshold=NEAR_DUPLICATE_DRAFT_THRESHOLD):
+    # reuse follow-up drafts of stored or same-batch near-duplicates, generating one per new template; drafts
+    # name the client and repeat their details, so one is only reused for the recipient it was written for
+    matches = find_near_duplicates(conn, [message_signature(m) for m in messages], threshold, recipients)
+    drafts, firsts = reuse_near_duplicates(
+        messages, [match and match[2] for match in matches], threshold, generate_all, recipients
+    )
+    new = [i for i in firsts if message_signature(messages[i]) is not None]
+    # attach each draft to the message's own signature, or store a new one if it has none yet
+    set_near_duplicate_drafts(
+        conn, [(messages[i]["near_duplicate_id"], drafts[i], recipients[i]) for i in new if "near_duplicate_id" in messages[i]]
+    )
+    put_near_duplicates(
+        conn, [(message_signature(messages[i]), True, drafts[i], recipients[i]) for i in new if "near_duplicate_id" not in messages[i]]
+    )
+    record_near_duplicates("draft", len(messages), len(messages) - len(firsts))
+    return drafts
+
+def cached_classify_many(conn, messages, classify_all):
+    # classify message dicts (with "id" and "body"), sending only cache misses to `classify_all`
+    verdicts = [get_verdict(conn, m["id"], m["body"]) for m in messages]
+    misses = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    if misses:
+        missed = [messages[i] for i in misses]
+        # templated emails reuse the verdict of a near-duplicate instead of asking again
+        fresh = classify_near_duplicates(conn, missed, classify_all) if NEAR_DUPLICATE_ENABLED else classify_all(missed)
+        for i, verdict in zip(misses, fresh):
+            verdicts[i] = verdict
+        put_verdicts(conn, [(messages[i]["id"], messages[i]["body"], verdicts[i]) for i in misses])
+    return verdicts
@@ -0,0 +1,88 @@
+import os
+import re
+import json
+from deepseek import ask_deepseek, map_concurrently
+from normalize import CHARS_PER_TOKEN, message_text
+from prefilter import prefilter
+
+# rough prompt budget per batched classification request, in tokens
+CLASSIFY_BATCH_TOKEN_BUDGET = int(os.getenv("CLASSIFY_BATCH_TOKEN_BUDGET", 6000))
+# maximum number of emails packed into one request
+CLASSIFY_BATCH_MAX_EMAILS = int(os.getenv("CLASSIFY_BATCH_MAX_EMAILS", 20))
+# each email is truncated to this many characters inside a batch
+CLASSIFY_EMAIL_MAX_CHARS = int(os.getenv("CLASSIFY_EMAIL_MAX_CHARS", 2000))
+
+BATCH_PROMPT = (
+    "For each email below, decide whether it is a business proposal or pitch. "
+    "Reply only with a JSON array containing one object per email, "
+    "like [{\"id\": \"1\", \"proposal\": true}], and nothing else.\n\n"
+)
+
+def estimate_tokens(text):
+    # approximate token count of a piece of text
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def is_proposal(body):
+    # ask DeepSeek whether the email is a business proposal
+    classify_prompt = f"Is the following email a business proposal or pitch? Reply only 'Yes' or 'No'.\n\n{body}"
+    result = ask_deepseek(classify_prompt).strip().lower()
+    return "yes" in result
+
+def pack_batches(bodies, token_budget=CLASSIFY_BATCH_TOKEN_BUDGET, max_emails=CLASSIFY_BATCH_MAX_EMAILS):
+    # group email indexes into batches that fit the token budget
+    batches = []
+    batch = []
+    used = estimate_tokens(BATCH_PROMPT)
+    for i, body in enumerate(bodies):
+        cost = estimate_tokens(body[:CLASSIFY_EMAIL_MAX_CHARS]) + 10
+        if batch and (used + cost > token_budget or len(batch) == max_emails):
+            batches.append(batch)
+            batch = []
+            used = estimate_tokens(BATCH_PROMPT)
+        batch.append(i)
+        used += cost
+    if batch:
+        batches.append(batch)
+    return batches
+
+def parse_batch_verdicts(reply, count):
+    # parse the JSON verdict array, raising ValueError if it is unusable
+    match = re.search(r"\[.*\]", reply, re.DOTALL)
+    if not match:
+        raise ValueError("no JSON array in reply")
+    verdicts = {}
+    for item in json.loads(match.group(0)):
+        # only real JSON booleans; bool("false") would be True
+        if not isinstance(item["proposal"], bool):
+            raise ValueError(f"verdict {item['proposal']!r} is not a boolean")
+        verdicts[str(item["id"])] = item["proposal"]
+    if any(str(i + 1) not in verdicts for i in range(count)):
+        raise ValueError("reply is missing verdicts")
+    return [verdicts[str(i + 1)] for i in range(count)]
+
+def classify_batch(bodies):
+    # classify several emails with a single DeepSeek request
+    if len(bodies) == 1:
+        return [is_proposal(bodies[0])]
+    prompt = BATCH_PROMPT
+    for i, body in enumerate(bodies):
+        prompt += f"### Email id {i + 1}\n{body[:CLASSIFY_EMAIL_MAX_CHARS]}\n\n"
+    reply = ask_deepseek(prompt)
+    try:
+        return parse_batch_verdicts(reply, len(bodies))
+    except (ValueError, KeyError, TypeError):
+        # fall back to one request per email if the JSON can't be used
+        print(f"⚠️ Batched classification reply unusable, classifying {len(bodies)} emails one by one.")
+        return [is_proposal(body) for body in bodies]
+
+def classify_emails(messages):
+    # classify message dicts: confident cases locally, the rest in concurrent DeepSeek batches
+    verdicts = [prefilter(m.get("subject", ""), message_text(m)) for m in messages]
+    pending = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    bodies = [message_text(messages[i]) for i in pending]
+    batches = pack_batches(bodies)
+    results = map_concurrently(classify_batch, [[bodies[i] for i in batch] for batch in batches])
+    for batch, batch_verdicts in zip(batches, results):
+        for i, verdict in zip(batch, batch_verdicts):
+            verdicts[pending[i]] = verdict
+    return verdicts
@@ -0,0 +1,39 @@
+import time
+started = time.perf_counter()
+
+import sys
+import argparse
+import importlib
+from dotenv import load_dotenv
+load_dotenv()
+
+# provider name -> module implementing run(daemon, interval); only the chosen one is imported
+PROVIDERS = {
+    "gmail": "main",
+    "outlook": "main_outlook"
+}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="email-automator", description="Follow up on business proposals sent from Gmail or Outlook")
+    parser.add_argument("provider", choices=sorted(PROVIDERS), help="mailbox provider to run against")
+    parser.add_argument("--daemon", action="store_true", help="keep running and repeat the follow-up cycle")
+    parser.add_argument("--interval", type=int, help="seconds between cycles in daemon mode (default: DAEMON_INTERVAL_SECONDS)")
+    args = parser.parse_args(argv)
+
+    # import the selected provider and its dependencies only
+    import_started = time.perf_counter()
+    provider = importlib.import_module(PROVIDERS[args.provider])
+    import_seconds = time.perf_counter() - import_started
+    startup_seconds = time.perf_counter() - started
+    from metrics import record_startup
+    record_startup("import", import_seconds)
+    record_startup("total", startup_seconds)
+    print(f"🚀 Started {args.provider} in {startup_seconds * 1000:.0f} ms ({import_seconds * 1000:.0f} ms importing the provider).")
+
+    if args.interval is None:
+        provider.run(args.daemon)
+    else:
+        provider.run(args.daemon, args.interval)
+
+if __name__ == "__main__":
+    sys.exit(main())
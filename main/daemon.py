@@ -0,0 +1,20 @@
+import os
+import time
+import traceback
+
+# seconds between the start of one follow-up cycle and the next
+DAEMON_INTERVAL_SECONDS = int(os.getenv("DAEMON_INTERVAL_SECONDS", 900))
+
+def run_forever(cycle, interval=DAEMON_INTERVAL_SECONDS):
+    # run cycle() every `interval` seconds until interrupted
+    print(f"🔁 Daemon mode: running every {interval} seconds. Press Ctrl+C to stop.")
+    while True:
+        started = time.monotonic()
+        try:
+            cycle()
+        except Exception:
+            # one failed cycle shouldn't stop the daemon
+            print("⚠️ Follow-up cycle failed:")
+            traceback.print_exc()
+        # keep a fixed schedule regardless of how long the cycle took
+        time.sleep(max(0, interval - (time.monotonic() - started)))
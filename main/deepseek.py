@@ -0,0 +1,115 @@
+import os
+import time
+import random
+import threading
+import email.utils
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from http_session import endpoint_name, session
+from metrics import record_call, record_retry, record_usage
+
+# load DeepSeek API key
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_URL = os.getenv("DEEPSEEK_API_URL", "https://api.deepseek.com/v1/chat/completions")
+
+# per-request timeout in seconds
+DEEPSEEK_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT", 60))
+# how many times a request is retried on 429/5xx or network errors
+DEEPSEEK_MAX_RETRIES = int(os.getenv("DEEPSEEK_MAX_RETRIES", 5))
+# base and maximum delay for exponential backoff, in seconds
+DEEPSEEK_BACKOFF_BASE = float(os.getenv("DEEPSEEK_BACKOFF_BASE", 1))
+DEEPSEEK_BACKOFF_MAX = float(os.getenv("DEEPSEEK_BACKOFF_MAX", 60))
+# maximum number of requests in flight at once
+DEEPSEEK_MAX_IN_FLIGHT = int(os.getenv("DEEPSEEK_MAX_IN_FLIGHT", 8))
+# token bucket: sustained requests per second and burst size
+DEEPSEEK_RATE_PER_SECOND = float(os.getenv("DEEPSEEK_RATE_PER_SECOND", 5))
+DEEPSEEK_BURST = int(os.getenv("DEEPSEEK_BURST", 10))
+
+# status codes worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    # thread-safe token bucket rate limiter
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # block until a token is available, then take it
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+rate_limiter = TokenBucket(DEEPSEEK_RATE_PER_SECOND, DEEPSEEK_BURST)
+# shared by every thread pool (classify workers, mailboxes), so the in-flight limit holds for the whole process
+in_flight = threading.BoundedSemaphore(DEEPSEEK_MAX_IN_FLIGHT)
+
+def retry_delay(response, attempt):
+    # honour Retry-After (seconds or HTTP date) when the server sends it
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        if retry_after.isdigit():
+            return min(float(retry_after), DEEPSEEK_BACKOFF_MAX)
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            retry_at = None
+        if retry_at is not None:
+            return min(max(retry_at.timestamp() - time.time(), 0), DEEPSEEK_BACKOFF_MAX)
+    # otherwise exponential backoff with jitter
+    return min(DEEPSEEK_BACKOFF_BASE * 2 ** attempt, DEEPSEEK_BACKOFF_MAX) * random.uniform(0.5, 1)
+
+def ask_deepseek(prompt):
+    # prepare headers for DeepSeek request
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
+    }
+    json_data = {
+        "model": "deepseek-chat",
+        "messages": [{"role": "user", "content": prompt}]
+    }
+    for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+        rate_limiter.acquire()
+        if attempt:
+            record_retry(endpoint_name(DEEPSEEK_URL))
+        start = time.perf_counter()
+        try:
+            with in_flight:
+                response = session.post(DEEPSEEK_URL, headers=headers, json=json_data, timeout=DEEPSEEK_TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout):
+            # network failures never reach the session's response hook
+            record_call(endpoint_name(DEEPSEEK_URL), time.perf_counter() - start, error=True)
+            # back off and retry
+            if attempt == DEEPSEEK_MAX_RETRIES:
+                raise
+            time.sleep(retry_delay(None, attempt))
+            continue
+        if response.status_code in RETRY_STATUS_CODES and attempt < DEEPSEEK_MAX_RETRIES:
+            time.sleep(retry_delay(response, attempt))
+            continue
+        # raise exception if request ultimately failed
+        response.raise_for_status()
+        data = response.json()
+        # track token usage per run
+        record_usage(data.get("usage"))
+        # return AI output
+        return data["choices"][0]["message"]["content"]
+
+def map_concurrently(func, items, max_workers=DEEPSEEK_MAX_IN_FLIGHT):
+    # run func over items on a bounded thread pool, keeping input order
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(func, items))
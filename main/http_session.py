@@ -0,0 +1,29 @@
+import os
+import urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from metrics import record_call
+
+# connections kept alive per host; should be at least the number of concurrent workers
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 20))
+
+def endpoint_name(url):
+    # metrics label for a URL: host and path, without the query string
+    parts = urllib.parse.urlsplit(url)
+    return parts.netloc + parts.path
+
+def record_response(response, *args, **kwargs):
+    # count and time every call made through the session
+    record_call(endpoint_name(response.url), response.elapsed.total_seconds(), error=response.status_code >= 400)
+
+def create_session(pool_size=HTTP_POOL_SIZE):
+    # session with a keep-alive connection pool, so TLS handshakes are reused
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(record_response)
+    return session
+
+# shared by DeepSeek and Graph calls
+session = create_session()
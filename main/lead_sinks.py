@@ -0,0 +1,186 @@
+import os
+import re
+import threading
+from metrics import timed_call
+
+# rows buffered per workbook or sheet before an intermediate flush (0 = only flush at the end of the run)
+LEAD_FLUSH_BATCH_SIZE = int(os.getenv("LEAD_FLUSH_BATCH_SIZE", 0))
+
+# retries for Sheets writes; googleapiclient backs off exponentially on 429, 403 rate limits and 5xx
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", 5))
+
+# header row for new lead workbooks
+LEAD_HEADER = ["Date", "Client", "Subject", "Status"]
+# position of the status in a lead row (column D)
+STATUS_COLUMN = 3
+STATUS_COLUMN_LETTER = "D"
+# lead rows in Google Sheets
+SHEET_NAME = "Sheet1"
+SHEET_RANGE = f"{SHEET_NAME}!A:D"
+
+def lead_key(row):
+    # leads are identified by (client, subject); the client address is case-insensitive
+    return (str(row[1]).strip().lower(), str(row[2]).strip())
+
+def first_row_of_range(a1_range):
+    # first row number of an A1 range like "Sheet1!A12:D14", or None
+    match = re.search(r"![A-Z]+(\d+)", a1_range or "")
+    return int(match.group(1)) if match else None
+
+def load_excel_index(filename):
+    # {(client, subject): [row_number, status]} for an existing workbook
+    import openpyxl
+    if not os.path.exists(filename):
+        return {}
+    wb = openpyxl.load_workbook(filename, read_only=True)
+    try:
+        index = {}
+        # row 1 is the header
+        for row_number, row in enumerate(wb.active.iter_rows(min_row=2, max_col=4, values_only=True), start=2):
+            if len(row) >= 4 and row[1] is not None:
+                index[lead_key(row)] = [row_number, row[3]]
+        return index
+    finally:
+        wb.close()
+
+def write_rows_to_excel(filename, appends, updates):
+    # only the Excel sink needs openpyxl
+    import openpyxl
+    # check if Excel file exists
+    if not os.path.exists(filename):
+        # create workbook and worksheet if file doesn't exist
+        wb = openpyxl.Workbook()
+        ws = wb.active
+        # add header row
+        ws.append(LEAD_HEADER)
+    else:
+        # load existing workbook
+        wb = openpyxl.load_workbook(filename)
+        ws = wb.active
+    # change the status of existing leads in place
+    for row_number, row in updates:
+        ws.cell(row=row_number, column=STATUS_COLUMN + 1, value=row[STATUS_COLUMN])
+    # append all new rows to worksheet
+    first_row = ws.max_row + 1
+    for row in appends:
+        ws.append(row)
+    # save workbook once for the whole batch
+    wb.save(filename)
+    return first_row
+
+def load_sheet_index(service, sheet_id):
+    # {(client, subject): [row_number, status]} read with a single request
+    response = service.spreadsheets().values().get(
+        spreadsheetId=sheet_id,
+        range=SHEET_RANGE
+    ).execute(num_retries=SHEETS_MAX_RETRIES)
+    index = {}
+    for row_number, row in enumerate(response.get("values", []), start=1):
+        if row_number > 1 and len(row) >= 4:
+            index[lead_key(row)] = [row_number, row[3]]
+    return index
+
+def write_rows_to_sheet(service, sheet_id, appends, updates):
+    # one batchUpdate for the status changes, one append for the new rows
+    values = service.spreadsheets().values()
+    if updates:
+        data = [
+            {"range": f"{SHEET_NAME}!{STATUS_COLUMN_LETTER}{row_number}", "values": [[str(row[STATUS_COLUMN])]]}
+            for row_number, row in updates
+        ]
+        values.batchUpdate(
+            spreadsheetId=sheet_id,
+            body={"valueInputOption": "RAW", "data": data}
+        ).execute(num_retries=SHEETS_MAX_RETRIES)
+    if not appends:
+        return None
+    # dates and other values are written as plain text
+    body = {"values": [[str(value) for value in row] for row in appends]}
+    response = values.append(
+        spreadsheetId=sheet_id,
+        range=SHEET_RANGE,
+        valueInputOption="RAW",
+        insertDataOption="INSERT_ROWS",
+        body=body
+    ).execute(num_retries=SHEETS_MAX_RETRIES)
+    return first_row_of_range(response.get("updates", {}).get("updatedRange"))
+
+class BufferedLeadSink:
+    # lead store: collects upserts during a run and applies them to each target once per flush,
+    # checking duplicates against an index of the target's (client, subject) keys loaded once per run
+    def __init__(self, batch_size=LEAD_FLUSH_BATCH_SIZE):
+        self.batch_size = batch_size
+        self.pending = {}
+        self.indexes = {}
+        # one store can be fed by several pipelines at once (e.g. one per Outlook mailbox)
+        self.lock = threading.RLock()
+
+    def upsert(self, target, row):
+        # buffer a [date, client, subject, status] row; the last upsert per lead wins
+        with self.lock:
+            rows = self.pending.setdefault(target, {})
+            rows[lead_key(row)] = row
+            if self.batch_size and len(rows) >= self.batch_size:
+                self.flush(target)
+
+    def flush(self, target=None):
+        # write buffered rows for one target, or all of them
+        with self.lock:
+            targets = [target] if target else list(self.pending)
+            for name in targets:
+                rows = self.pending.pop(name, {})
+                if rows:
+                    self.apply(name, rows)
+
+    def apply(self, target, rows):
+        if target not in self.indexes:
+            self.indexes[target] = self.load_index(target)
+        index = self.indexes[target]
+        # new leads are appended; known leads only change if their status did
+        appends = [row for key, row in rows.items() if key not in index]
+        updates = [
+            (index[key][0], row) for key, row in rows.items()
+            if key in index and index[key][1] != row[STATUS_COLUMN]
+        ]
+        if not appends and not updates:
+            return
+        first_row = self.write(target, appends, updates)
+        for row_number, row in updates:
+            index[lead_key(row)][1] = row[STATUS_COLUMN]
+        if appends and first_row is None:
+            # row numbers of the new rows are unknown; reload the index on the next flush
+            del self.indexes[target]
+        elif appends:
+            for offset, row in enumerate(appends):
+                index[lead_key(row)] = [first_row + offset, row[STATUS_COLUMN]]
+
+    def load_index(self, target):
+        raise NotImplementedError
+
+    def write(self, target, appends, updates):
+        # apply [(row_number, row)] status updates and append rows; return the first appended row number
+        raise NotImplementedError
+
+class ExcelLeadSink(BufferedLeadSink):
+    # targets are workbook filenames
+    def load_index(self, target):
+        with timed_call("excel.read"):
+            return load_excel_index(target)
+
+    def write(self, target, appends, updates):
+        with timed_call("excel.write"):
+            return write_rows_to_excel(target, appends, updates)
+
+class SheetsLeadSink(BufferedLeadSink):
+    # targets are Google Sheet IDs
+    def __init__(self, service, batch_size=LEAD_FLUSH_BATCH_SIZE):
+        super().__init__(batch_size)
+        self.service = service
+
+    def load_index(self, target):
+        with timed_call("sheets.values.get"):
+            return load_sheet_index(self.service, target)
+
+    def write(self, target, appends, updates):
+        with timed_call("sheets.values.write"):
+            return write_rows_to_sheet(self.service, target, appends, updates)
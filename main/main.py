@@ -2,17 +2,29 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import argparse
 import base64
 import datetime
+import json
+import threading
+import time
 from email.mime.text import MIMEText
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
-import requests
-
-# load DeepSeek API key
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+import google_auth_httplib2
+import httplib2
+from classification_cache import open_cache
+from daemon import DAEMON_INTERVAL_SECONDS, run_forever
+from deepseek import retry_delay
+from lead_sinks import SheetsLeadSink
+from metrics import profiled, record_retry, timed_call, write_summary
+from normalize import html_to_text
+from outbox import DAILY_LIMIT, open_outbox
+from pipeline import report_run, run_pipeline, start_run
+from sync_state import INCREMENTAL_SYNC, open_sync_state, get_cursor, set_cursor, track_messages, tracked_in_window
+from utils import chunked
 
 # Gmail + Sheets API scopes
 SCOPES = [
@@ -25,7 +37,34 @@ SCOPES = [
 LEADS_SHEET_ID = "YOUR_LEADS_SHEET_ID"
 LOST_LEADS_SHEET_ID = "YOUR_LOST_LEADS_SHEET_ID"
 
-def authenticate():
+# Gmail accepts at most 100 calls in a single batch HTTP request
+GMAIL_BATCH_SIZE = 100
+# maximum page size for messages().list
+GMAIL_LIST_PAGE_SIZE = 500
+# partial responses: only ask Gmail for the fields we actually read
+LIST_FIELDS = "messages/id,nextPageToken"
+FULL_FIELDS = "id,threadId,internalDate,payload"
+HISTORY_FIELDS = "history/messagesAdded/message/id,historyId,nextPageToken"
+THREAD_FIELDS = "id,messages(id,internalDate,labelIds)"
+# retries for throttled (429, 5xx, rate-limit 403) Gmail calls and batch items
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", 5))
+# 403 reasons Gmail uses for throttling, retried like a 429 (as googleapiclient does for single calls)
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+# 403 reasons for a used-up daily quota; sending pauses for the account
+DAILY_LIMIT_REASONS = {"dailyLimitExceeded"}
+
+# in daemon mode, refresh the OAuth token when it has less than this many seconds left
+TOKEN_REFRESH_MARGIN_SECONDS = int(os.getenv("TOKEN_REFRESH_MARGIN_SECONDS", 600))
+
+def refresh_token(creds):
+    # imported here, it's only needed when a token is refreshed
+    from google.auth.transport.requests import Request
+    creds.refresh(Request())
+    # save token for future use
+    with open('token.json', 'w') as token:
+        token.write(creds.to_json())
+
+def load_credentials():
     # check for existing token
     creds = None
     if os.path.exists('token.json'):
@@ -34,16 +73,41 @@ def authenticate():
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             # refresh token if expired
-            creds.refresh(Request())
-        else:
-            # run OAuth flow for new token
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
+            refresh_token(creds)
+            return creds
+        # run OAuth flow for new token (imported here, it's only needed on first use)
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+        creds = flow.run_local_server(port=0)
         # save token for future use
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
+    return creds
+
+def refresh_credentials(creds, margin=TOKEN_REFRESH_MARGIN_SECONDS):
+    # refresh the token ahead of expiry so a long-running process never hits it mid-cycle
+    if creds.expiry and creds.expiry - datetime.datetime.utcnow() < datetime.timedelta(seconds=margin):
+        refresh_token(creds)
+
+def build_services(creds):
+    # httplib2 isn't thread-safe, so every thread gets its own authorized connection
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(local, "http"):
+            local.http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http())
+        return HttpRequest(local.http, *args, **kwargs)
+
+    # return Gmail service and Sheets service, built from the discovery documents bundled
+    # with googleapiclient rather than fetched over the network
+    return (
+        build('gmail', 'v1', credentials=creds, requestBuilder=build_request, static_discovery=True, cache_discovery=False),
+        build('sheets', 'v4', credentials=creds, requestBuilder=build_request, static_discovery=True, cache_discovery=False)
+    )
+
+def authenticate():
     # return Gmail service and Sheets service
-    return build('gmail', 'v1', credentials=creds), build('sheets', 'v4', credentials=creds)
+    return build_services(load_credentials())
 
 def send_email(service, to, subject, body):
     # create email message
@@ -54,92 +118,316 @@ def send_email(service, to, subject, body):
     raw = base64.urlsafe_b64encode(message.as_bytes()).decode()
     body = {'raw': raw}
     # send email via Gmail API
-    sent = service.users().messages().send(userId="me", body=body).execute()
+    with timed_call("gmail.messages.send"):
+        sent = service.users().messages().send(userId="me", body=body).execute()
     print(f"✅ Email sent to {to}. Message ID: {sent['id']}")
 
-def ask_deepseek(prompt):
-    # prepare headers for DeepSeek request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-    json_data = {
-        "model": "deepseek-chat",
-        "messages": [{"role": "user", "content": prompt}]
+def list_message_ids(gmail_service, query):
+    # page through every message matching the query, following nextPageToken
+    page_token = None
+    while True:
+        with timed_call("gmail.messages.list"):
+            response = gmail_service.users().messages().list(
+                userId="me",
+                q=query,
+                maxResults=GMAIL_LIST_PAGE_SIZE,
+                pageToken=page_token,
+                fields=LIST_FIELDS
+            ).execute(num_retries=GMAIL_MAX_RETRIES)
+        for msg in response.get('messages', []):
+            yield msg['id']
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+
+def error_reason(error):
+    # the `reason` of a Google API error, or '' if the response has none
+    try:
+        return json.loads(error.content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return ""
+
+def is_throttled(error):
+    # whether a failed Gmail call is worth retrying after a backoff
+    status = error.resp.status
+    return status == 429 or status >= 500 or (status == 403 and error_reason(error) in RATE_LIMIT_REASONS)
+
+def batch_get(gmail_service, resource, item_ids, **params):
+    # fetch the given messages or threads with batch HTTP requests, keyed by ID; items Gmail throttles
+    # are fetched again in a follow-up batch after a backoff. Returns (items found, IDs still throttled)
+    results = {}
+    pending = list(item_ids)
+    for attempt in range(GMAIL_MAX_RETRIES + 1):
+        if attempt:
+            record_retry("gmail.batch")
+            time.sleep(retry_delay(None, attempt - 1))
+        throttled = []
+
+        def callback(request_id, response, exception):
+            if exception is None:
+                results[request_id] = response
+            elif isinstance(exception, HttpError) and is_throttled(exception):
+                throttled.append(request_id)
+            else:
+                # e.g. a message deleted since it was listed; retrying won't help
+                print(f"⚠️ Could not fetch {request_id}: {exception}")
+
+        batch = gmail_service.new_batch_http_request(callback=callback)
+        for item_id in pending:
+            batch.add(resource.get(userId="me", id=item_id, **params), request_id=item_id)
+        with timed_call("gmail.batch"):
+            batch.execute()
+        pending = throttled
+        if not pending:
+            break
+    if pending:
+        print(f"⚠️ Gmail kept throttling {len(pending)} items; they will be fetched next run.")
+    # keep the original listing order
+    return [results[item_id] for item_id in item_ids if item_id in results], pending
+
+def batch_get_messages(gmail_service, message_ids, **params):
+    return batch_get(gmail_service, gmail_service.users().messages(), message_ids, **params)
+
+def batch_get_threads(gmail_service, thread_ids, **params):
+    return batch_get(gmail_service, gmail_service.users().threads(), thread_ids, **params)
+
+def find_replies(gmail_service, thread_ids):
+    # time of the latest message we didn't send in each thread (None if there is none)
+    replies = {}
+    for chunk in chunked(thread_ids, GMAIL_BATCH_SIZE):
+        # threads that couldn't be fetched are left out
+        threads, _ = batch_get_threads(gmail_service, chunk, format='metadata', fields=THREAD_FIELDS)
+        for thread in threads:
+            received = [
+                int(m['internalDate']) / 1000
+                for m in thread.get('messages', [])
+                if not {'SENT', 'DRAFT'} & set(m.get('labelIds', []))
+            ]
+            replies[thread['id']] = max(received, default=None)
+    return replies
+
+def get_header(headers, name):
+    # return the value of a message header, or '' if it is missing
+    return next((h['value'] for h in headers if h['name'] == name), '')
+
+def find_part(payload, mime_type):
+    # depth-first search of the MIME tree for the first non-attachment part of this type
+    if payload.get('mimeType') == mime_type and payload.get('body', {}).get('data') and not payload.get('filename'):
+        return payload
+    for part in payload.get('parts', []):
+        found = find_part(part, mime_type)
+        if found:
+            return found
+    return None
+
+def decode_part(part):
+    return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='replace')
+
+def get_body(payload):
+    # get the text/plain body anywhere in the MIME tree (e.g. inside multipart/alternative),
+    # falling back to the HTML body converted to text
+    part = find_part(payload, 'text/plain')
+    if part:
+        return decode_part(part)
+    part = find_part(payload, 'text/html')
+    if part:
+        return html_to_text(decode_part(part))
+    return ""
+
+def parse_message(msg_data):
+    headers = msg_data['payload']['headers']
+    # get email subject, recipient and body
+    return {
+        "id": msg_data['id'],
+        "thread_id": msg_data.get('threadId'),
+        # internalDate is in milliseconds
+        "sent_at": int(msg_data.get('internalDate', 0)) / 1000,
+        "subject": get_header(headers, 'Subject'),
+        "to": get_header(headers, 'To'),
+        "body": get_body(msg_data['payload'])
     }
-    # send request and return AI output
-    response = requests.post("https://api.deepseek.com/v1/chat/completions", headers=headers, json=json_data)
-    response.raise_for_status()
-    return response.json()["choices"][0]["message"]["content"]
-
-def append_to_sheet(service, sheet_id, row):
-    # append a row to the Google Sheet
-    sheet = service.spreadsheets()
-    body = {"values": [row]}
-    sheet.values().append(
-        spreadsheetId=sheet_id,
-        range="Sheet1!A:D",
-        valueInputOption="RAW",
-        insertDataOption="INSERT_ROWS",
-        body=body
-    ).execute()
-
-def follow_up_logic(gmail_service, sheets_service):
+
+def fetch_sent_messages(gmail_service, query, failed=None):
+    # stream full messages matching the query, one batch at a time; IDs Gmail kept throttling go to `failed`
+    for message_ids in chunked(list_message_ids(gmail_service, query), GMAIL_BATCH_SIZE):
+        # nearly all sent mail has a recipient, so a separate metadata pass to find candidates
+        # would only double the messages.get quota; fetch in full and filter afterwards
+        messages, throttled = batch_get_messages(gmail_service, message_ids, format='full', fields=FULL_FIELDS)
+        if failed is not None:
+            failed.extend(throttled)
+        # only messages with a recipient can be followed up on
+        yield from (m for m in messages if get_header(m['payload'].get('headers', []), 'To'))
+
+def list_added_message_ids(gmail_service, start_history_id):
+    # collect IDs of sent messages added since the given historyId
+    message_ids = []
+    page_token = None
+    while True:
+        with timed_call("gmail.history.list"):
+            response = gmail_service.users().history().list(
+                userId="me",
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                labelId='SENT',
+                pageToken=page_token,
+                fields=HISTORY_FIELDS
+            ).execute(num_retries=GMAIL_MAX_RETRIES)
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message_ids.append(added['message']['id'])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            # drop duplicates but keep order
+            return list(dict.fromkeys(message_ids)), response.get('historyId', start_history_id)
+
+def sync_sent_messages(gmail_service, state, since):
+    # bring the local message store up to date, using the history API after the first run
+    history_id = get_cursor(state, "gmail")
+    if history_id:
+        try:
+            message_ids, history_id = list_added_message_ids(gmail_service, history_id)
+        except HttpError as error:
+            # history IDs expire after about a week; fall back to a full resync
+            if error.resp.status != 404:
+                raise
+            history_id = None
+    # messages that couldn't be downloaded; the cursor stays put until they are
+    failed = []
+    if history_id:
+        # only download the messages added since the last run
+        def added_messages():
+            for ids in chunked(message_ids, GMAIL_BATCH_SIZE):
+                found, throttled = batch_get_messages(gmail_service, ids, format='full', fields=FULL_FIELDS)
+                failed.extend(throttled)
+                yield from found
+        messages = added_messages()
+    else:
+        # first run: record the starting point before listing so nothing slips through
+        with timed_call("gmail.getProfile"):
+            history_id = gmail_service.users().getProfile(userId="me", fields="historyId").execute(num_retries=GMAIL_MAX_RETRIES)['historyId']
+        messages = fetch_sent_messages(gmail_service, f"after:{int(since)} in:sent", failed)
+    added = 0
+    for chunk in chunked(messages, GMAIL_BATCH_SIZE):
+        added += len(chunk)
+        # internalDate is in milliseconds
+        track_messages(state, "gmail", [(m['id'], int(m['internalDate']) / 1000, m) for m in chunk])
+    if failed:
+        # keep the old cursor so the next run lists the missing messages again; storing the others twice is harmless
+        print(f"⚠️ {len(failed)} new sent messages couldn't be downloaded; they will be synced next run.")
+    else:
+        set_cursor(state, "gmail", history_id)
+    print(f"Synced {added} new sent messages.")
+
+class GmailProvider:
+    # Gmail adapter for the shared follow-up pipeline; leads go to Google Sheets
+    name = "gmail"
+    # messages.send takes one email per call, so the scheduler hands over one at a time
+    send_batch_size = 1
+
+    def __init__(self, gmail_service, sheets_service, sent_messages):
+        self.gmail_service = gmail_service
+        self.sent_messages = sent_messages
+        # lead rows are buffered and written with one append per sheet
+        self.leads = SheetsLeadSink(sheets_service)
+        self.leads_target = LEADS_SHEET_ID
+        self.lost_leads_target = LOST_LEADS_SHEET_ID
+
+    def fetch_pages(self):
+        # one page per fetched batch of messages
+        for chunk in chunked(self.sent_messages, GMAIL_BATCH_SIZE):
+            yield [parse_message(msg_data) for msg_data in chunk]
+
+    def find_replies(self, messages):
+        # one batched threads.get per 100 threads
+        return find_replies(self.gmail_service, list(dict.fromkeys(m["thread_id"] for m in messages)))
+
+    def send(self, emails):
+        # one result per email for the send scheduler: None if sent, else (status, Retry-After)
+        results = []
+        for to, subject, body in emails:
+            try:
+                send_email(self.gmail_service, to, subject, body)
+                results.append(None)
+            except HttpError as error:
+                reason = error_reason(error) if error.resp.status == 403 else ""
+                if reason in DAILY_LIMIT_REASONS:
+                    results.append((DAILY_LIMIT, None))
+                elif reason in RATE_LIMIT_REASONS:
+                    # Gmail's rate-limit 403s are retried like a 429 (googleapiclient does the same)
+                    results.append((429, error.resp.get("retry-after")))
+                else:
+                    results.append((error.resp.status, error.resp.get("retry-after")))
+            except (OSError, httplib2.HttpLib2Error):
+                # network error
+                results.append((0, None))
+        return results
+
+def follow_up_logic(gmail_service, sheets_service, incremental=INCREMENTAL_SYNC):
     # current UTC time
     now = datetime.datetime.utcnow()
     # timestamps for 2 and 7 days ago
     two_days_ago = now - datetime.timedelta(days=2)
     seven_days_ago = now - datetime.timedelta(days=7)
+    # per-run timings and call counters
+    start_run()
 
-    # Gmail search query for sent messages 2-7 days ago
-    query = f"after:{int(seven_days_ago.timestamp())} before:{int(two_days_ago.timestamp())} in:sent"
-    messages = gmail_service.users().messages().list(userId="me", q=query).execute().get('messages', [])
-
-    print(f"Found {len(messages)} sent messages between 2–7 days ago.")
-
-    for msg in messages:
-        # fetch full message data
-        msg_data = gmail_service.users().messages().get(userId="me", id=msg['id'], format='full').execute()
-        headers = msg_data['payload']['headers']
-        # get email subject and recipient
-        subject = next((h['value'] for h in headers if h['name'] == 'Subject'), '')
-        to = next((h['value'] for h in headers if h['name'] == 'To'), '')
-        # get message body
-        parts = msg_data['payload'].get('parts', [])
-        body = ""
-        if parts:
-            for part in parts:
-                if part['mimeType'] == 'text/plain':
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode()
-                    break
-        else:
-            body = base64.urlsafe_b64decode(msg_data['payload']['body']['data']).decode()
-
-        # classify email as proposal using DeepSeek
-        classify_prompt = f"Is the following email a business proposal or pitch? Reply only 'Yes' or 'No'.\n\n{body}"
-        result = ask_deepseek(classify_prompt).strip().lower()
-
-        if "yes" in result:
-            # add as open lead in Google Sheet
-            append_to_sheet(sheets_service, LEADS_SHEET_ID, [str(now.date()), to, subject, "Open Lead"])
-
-            # check if client rejected
-            if "we went with another company" in body.lower():
-                # add to lost leads sheet
-                append_to_sheet(sheets_service, LOST_LEADS_SHEET_ID, [str(now.date()), to, subject, "Lost Lead"])
-                # send sympathetic email
-                sympathetic_msg = "Thank you for considering us. We wish you success with your chosen provider."
-                send_email(gmail_service, to, f"RE: {subject}", sympathetic_msg)
-            else:
-                # generate polite follow-up via DeepSeek
-                followup_prompt = f"""Write a short, polite follow-up email paragraph to a client based on this previous message:
-\"\"\"{body}\"\"\""""
-                follow_up_body = ask_deepseek(followup_prompt).strip()
-                # send follow-up email
-                send_email(gmail_service, to, f"RE: {subject}", follow_up_body)
+    if incremental:
+        # fetch only what was added since the last run, then read the window from the local store
+        state = open_sync_state()
+        window_start = seven_days_ago.replace(tzinfo=datetime.timezone.utc).timestamp()
+        window_end = two_days_ago.replace(tzinfo=datetime.timezone.utc).timestamp()
+        sync_sent_messages(gmail_service, state, window_start)
+        sent_messages = tracked_in_window(state, "gmail", window_start, window_end)
+    else:
+        # Gmail search query for sent messages 2-7 days ago
+        query = f"after:{int(seven_days_ago.timestamp())} before:{int(two_days_ago.timestamp())} in:sent"
+        sent_messages = fetch_sent_messages(gmail_service, query)
 
-if __name__ == "__main__":
+    # verdict cache shared across daily runs
+    cache = open_cache()
+    # durable queue of follow-ups; anything left over from an earlier run is sent first
+    outbox = open_outbox()
+    provider = GmailProvider(gmail_service, sheets_service, sent_messages)
+    try:
+        # fetch, classify, record and send overlap in a staged pipeline
+        processed = run_pipeline(provider, cache, now.date(), outbox)
+    finally:
+        # write collected leads even if the run fails part way
+        provider.leads.flush()
+        cache.close()
+        outbox.close()
+        if incremental:
+            state.close()
+        # run summary for dashboards, also written for failed runs
+        summary = write_summary()
+
+    print(f"Processed {processed} sent messages between 2–7 days ago.")
+    report_run(summary)
+
+def run_daemon(interval=DAEMON_INTERVAL_SECONDS):
+    # authenticate and build the API clients once, then reuse them every cycle
+    creds = load_credentials()
+    gmail_service, sheets_service = build_services(creds)
+
+    def cycle():
+        refresh_credentials(creds)
+        follow_up_logic(gmail_service, sheets_service)
+
+    run_forever(cycle, interval)
+
+def run(daemon=False, interval=DAEMON_INTERVAL_SECONDS):
+    if daemon:
+        run_daemon(interval)
+        return
     # authenticate Gmail and Sheets services
     gmail_service, sheets_service = authenticate()
-    # run follow-up logic
-    follow_up_logic(gmail_service, sheets_service)
+    # run follow-up logic (profiled if PROFILE_OUTPUT is set)
+    with profiled():
+        follow_up_logic(gmail_service, sheets_service)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gmail follow-up automation")
+    parser.add_argument("--daemon", action="store_true", help="keep running and repeat the follow-up cycle")
+    parser.add_argument("--interval", type=int, default=DAEMON_INTERVAL_SECONDS, help="seconds between cycles in daemon mode")
+    args = parser.parse_args()
+    run(args.daemon, args.interval)
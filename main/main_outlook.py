@@ -2,37 +2,103 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import os
+import argparse
+import time
+import threading
+import urllib.parse
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from msal import ConfidentialClientApplication
-import openpyxl
+from msal import ConfidentialClientApplication, SerializableTokenCache
+from classification_cache import open_cache
+from daemon import DAEMON_INTERVAL_SECONDS, run_forever
+from deepseek import TokenBucket, retry_delay
+from http_session import endpoint_name, session
+from lead_sinks import ExcelLeadSink
+from metrics import profiled, record_mailbox, record_retry, write_summary
+from normalize import html_to_text
+from outbox import open_outbox
+from pipeline import report_run, run_pipeline, start_run
+from sync_state import INCREMENTAL_SYNC, open_sync_state, get_cursor, set_cursor, track_messages, untrack_messages, tracked_in_window
+from utils import chunked, shard_owner
 
-# load Outlook and DeepSeek credentials from environment variables
+# load Outlook credentials from environment variables
 CLIENT_ID = os.getenv("OUTLOOK_CLIENT_ID")
 CLIENT_SECRET = os.getenv("OUTLOOK_CLIENT_SECRET")
 TENANT_ID = os.getenv("OUTLOOK_TENANT_ID")
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
 # Microsoft Graph API scope and authority URL
 SCOPES = ["https://graph.microsoft.com/.default"]
 AUTHORITY = f"https://login.microsoftonline.com/{TENANT_ID}"
+# MSAL token cache persisted between runs (set to empty to keep it in memory only)
+MSAL_CACHE_FILE = os.getenv("MSAL_CACHE_FILE", "msal_token_cache.json")
+
+# Microsoft Graph API base URL
+GRAPH_URL = os.getenv("GRAPH_API_URL", "https://graph.microsoft.com/v1.0")
 
 # Excel files to store leads and lost leads
 LEADS_FILE = "leads.xlsx"
 LOST_LEADS_FILE = "lost_leads.xlsx"
 
-def authenticate_outlook():
+# Graph page size for message listings (nextLink is followed for the rest)
+GRAPH_PAGE_SIZE = 50
+# only the message properties we actually read
+MESSAGE_SELECT = "id,subject,toRecipients,body,conversationId,sentDateTime"
+
+# send follow-ups through the Graph JSON $batch endpoint (set to 0 for one request per email)
+GRAPH_BATCH_SENDS = os.getenv("GRAPH_BATCH_SENDS", "1") != "0"
+# Graph accepts at most 20 requests per $batch call
+GRAPH_BATCH_SIZE = 20
+# how many times throttled or failed batch items are retried
+GRAPH_BATCH_MAX_RETRIES = int(os.getenv("GRAPH_BATCH_MAX_RETRIES", 3))
+# how many times single Graph requests are retried on 429/503/504
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", 3))
+# Graph throttles each mailbox separately, so every mailbox gets its own request budget
+GRAPH_MAILBOX_RATE_PER_SECOND = float(os.getenv("GRAPH_MAILBOX_RATE_PER_SECOND", 10))
+GRAPH_MAILBOX_BURST = int(os.getenv("GRAPH_MAILBOX_BURST", 20))
+
+# multi-mailbox mode (app-only): comma-separated user IDs / UPNs, and/or a group whose members are processed
+OUTLOOK_MAILBOXES = [mailbox.strip() for mailbox in os.getenv("OUTLOOK_MAILBOXES", "").split(",") if mailbox.strip()]
+OUTLOOK_MAILBOX_GROUP = os.getenv("OUTLOOK_MAILBOX_GROUP", "")
+# mailboxes processed at the same time
+MAILBOX_WORKERS = int(os.getenv("MAILBOX_WORKERS", 4))
+# only handle this host's share of the mailboxes, as "index/count" (e.g. "0/3" on the first of three hosts)
+MAILBOX_SHARD = os.getenv("MAILBOX_SHARD", "")
+# messages read per conversation when looking for replies
+CONVERSATION_PAGE_SIZE = 50
+
+def create_outlook_app(cache_file=MSAL_CACHE_FILE):
+    # load the persisted token cache so earlier tokens can be reused
+    cache = SerializableTokenCache()
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache.deserialize(f.read())
     # create an MSAL confidential client
-    app = ConfidentialClientApplication(
+    return ConfidentialClientApplication(
         client_id=CLIENT_ID,
         authority=AUTHORITY,
-        client_credential=CLIENT_SECRET
+        client_credential=CLIENT_SECRET,
+        token_cache=cache
     )
-    # try to get a cached token silently
+
+def save_token_cache(app, cache_file=MSAL_CACHE_FILE):
+    # persist the token cache (readable by the owner only, it holds access tokens)
+    if cache_file and app.token_cache.has_state_changed:
+        fd = os.open(cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(app.token_cache.serialize())
+        app.token_cache.has_state_changed = False
+
+def authenticate_outlook(app=None):
+    if app is None:
+        app = create_outlook_app()
+    # try to get a cached token silently; MSAL treats tokens close to expiry as missing,
+    # so calling this before every daemon cycle refreshes them proactively
     result = app.acquire_token_silent(SCOPES, account=None)
     # if no cached token, request a new one
     if not result:
         result = app.acquire_token_for_client(scopes=SCOPES)
+    save_token_cache(app)
     # return access token if successful
     if "access_token" in result:
         return result["access_token"]
@@ -40,115 +106,402 @@ def authenticate_outlook():
         # raise exception if authentication failed
         raise Exception("Authentication failed", result.get("error_description"))
 
-def ask_deepseek(prompt):
-    # prepare headers for DeepSeek API request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
-    }
-    # payload for DeepSeek chat model
-    json_data = {
-        "model": "deepseek-chat",
-        "messages": [{"role": "user", "content": prompt}]
-    }
-    # send request and raise exception if error occurs
-    response = requests.post("https://api.deepseek.com/v1/chat/completions", headers=headers, json=json_data)
-    response.raise_for_status()
-    # return the AI response content
-    return response.json()["choices"][0]["message"]["content"]
+# per-mailbox rate limiters
+throttles = {}
+throttles_lock = threading.Lock()
 
-def send_email_outlook(access_token, to, subject, body):
-    # Outlook API endpoint for sending email
-    url = "https://graph.microsoft.com/v1.0/me/sendMail"
+def throttle(mailbox):
+    # wait for the mailbox's share of the Graph request budget
+    with throttles_lock:
+        bucket = throttles.get(mailbox)
+        if bucket is None:
+            bucket = throttles[mailbox] = TokenBucket(GRAPH_MAILBOX_RATE_PER_SECOND, GRAPH_MAILBOX_BURST)
+    bucket.acquire()
+
+def graph_request(method, url, mailbox=None, **kwargs):
+    # Graph request within the mailbox's rate limit; throttling only delays this mailbox's worker
+    for attempt in range(GRAPH_MAX_RETRIES + 1):
+        throttle(mailbox)
+        response = session.request(method, url, **kwargs)
+        if response.status_code not in (429, 503, 504) or attempt == GRAPH_MAX_RETRIES:
+            return response
+        record_retry(endpoint_name(url))
+        time.sleep(retry_delay(response, attempt))
+
+def mailbox_path(mailbox=None):
+    # the signed-in user, or any user's mailbox in app-only mode
+    return f"/users/{urllib.parse.quote(mailbox, safe='@')}" if mailbox else "/me"
+
+def mailbox_key(mailbox=None):
+    # key for a mailbox's sync checkpoints, reply and cooldown state
+    return f"outlook:{mailbox}" if mailbox else "outlook"
+
+def build_mail(to, subject, body):
     # construct email message payload
-    email_msg = {
+    return {
         "message": {
             "subject": subject,
             "body": {"contentType": "Text", "content": body},
             "toRecipients": [{"emailAddress": {"address": to}}]
         }
     }
+
+def send_email_outlook(access_token, to, subject, body, mailbox=None):
+    # Outlook API endpoint for sending email
+    url = f"{GRAPH_URL}{mailbox_path(mailbox)}/sendMail"
     # set authorization header with token
     headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
     # send the email
-    response = requests.post(url, headers=headers, json=email_msg)
+    response = graph_request("POST", url, mailbox, headers=headers, json=build_mail(to, subject, body))
     response.raise_for_status()
     print(f"✅ Email sent to {to}.")
 
-def append_to_excel(filename, row):
-    # check if Excel file exists
-    if not os.path.exists(filename):
-        # create workbook and worksheet if file doesn't exist
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        # add header row
-        ws.append(["Date", "Client", "Subject", "Status"])
+def run_graph_batch(access_token, batch_requests, mailbox=None, max_retries=GRAPH_BATCH_MAX_RETRIES):
+    # run {id: request} through Graph $batch, 20 per call, retrying throttled items; returns {id: response}
+    headers = {"Authorization": f"Bearer {access_token}", "Content-Type": "application/json"}
+    results = {}
+    for chunk in chunked(list(batch_requests.items()), GRAPH_BATCH_SIZE):
+        pending = dict(chunk)
+        for attempt in range(max_retries + 1):
+            batch = {"requests": [dict(request, id=request_id) for request_id, request in pending.items()]}
+            response = graph_request("POST", f"{GRAPH_URL}/$batch", mailbox, headers=headers, json=batch)
+            response.raise_for_status()
+            retry = {}
+            wait = 0
+            # each item in the batch succeeds or fails on its own
+            for item in response.json().get("responses", []):
+                if item["status"] in (429, 500, 502, 503, 504) and attempt < max_retries:
+                    # throttled or transient: retry after the longest Retry-After in the batch
+                    retry[item["id"]] = pending[item["id"]]
+                    record_retry(endpoint_name(f"{GRAPH_URL}/$batch"))
+                    retry_after = item.get("headers", {}).get("Retry-After")
+                    wait = max(wait, float(retry_after) if retry_after else retry_delay(None, attempt))
+                else:
+                    results[item["id"]] = item
+            if not retry:
+                break
+            time.sleep(wait)
+            pending = retry
+    return results
+
+def send_emails_outlook_batch(access_token, emails, mailbox=None):
+    # send (to, subject, body) emails through Graph $batch; returns one result per email,
+    # None if sent, else (status, Retry-After)
+    batch_requests = {
+        str(i): {
+            "method": "POST",
+            "url": f"{mailbox_path(mailbox)}/sendMail",
+            "headers": {"Content-Type": "application/json"},
+            "body": build_mail(*email)
+        }
+        for i, email in enumerate(emails)
+    }
+    # throttled sends are left to the send scheduler, which backs off for the whole mailbox
+    try:
+        responses = run_graph_batch(access_token, batch_requests, mailbox, max_retries=0)
+    except requests.HTTPError as error:
+        # the whole batch was throttled or rejected: every email gets its status and Retry-After
+        print(f"⚠️ Batch send failed with status {error.response.status_code}.")
+        return [(error.response.status_code, error.response.headers.get("Retry-After"))] * len(emails)
+    except requests.RequestException:
+        # network error
+        return [(0, None)] * len(emails)
+    results = []
+    for request_id, email in enumerate(emails):
+        item = responses.get(str(request_id), {"status": 0})
+        if item["status"] < 300 and item["status"]:
+            print(f"✅ Email sent to {email[0]}.")
+            results.append(None)
+        else:
+            print(f"⚠️ Email to {email[0]} failed with status {item['status']}.")
+            results.append((item["status"], item.get("headers", {}).get("Retry-After")))
+    return results
+
+def sender_address(msg):
+    # lower-cased sender address of a Graph message
+    return msg.get("from", {}).get("emailAddress", {}).get("address", "").lower()
+
+def find_replies_outlook(access_token, messages, mailbox=None):
+    # time of the latest message in each conversation not sent by us (None if there is none)
+    sent_ids = {m["id"] for m in messages}
+    conversation_ids = list(dict.fromkeys(m["thread_id"] for m in messages))
+    batch_requests = {}
+    for i, conversation_id in enumerate(conversation_ids):
+        # OData string literals escape quotes by doubling them
+        literal = conversation_id.replace("'", "''")
+        query = urllib.parse.quote(f"conversationId eq '{literal}'")
+        batch_requests[str(i)] = {
+            "method": "GET",
+            "url": f"{mailbox_path(mailbox)}/messages?$filter={query}&$select=id,from,receivedDateTime,isDraft&$top={CONVERSATION_PAGE_SIZE}"
+        }
+    replies = {}
+    for request_id, item in run_graph_batch(access_token, batch_requests, mailbox).items():
+        conversation_id = conversation_ids[int(request_id)]
+        if item["status"] >= 300:
+            print(f"⚠️ Could not check conversation {conversation_id} for replies (status {item['status']}).")
+            continue
+        found = [msg for msg in item.get("body", {}).get("value", []) if not msg.get("isDraft")]
+        # our own address, taken from the sent message itself
+        ours = {sender_address(msg) for msg in found if msg["id"] in sent_ids}
+        if not ours:
+            # our message isn't in the first page, so replies can't be told apart; check again next run
+            continue
+        received = [parse_graph_time(msg["receivedDateTime"]) for msg in found if sender_address(msg) not in ours]
+        replies[conversation_id] = max(received, default=None)
+    return replies
+
+def fetch_sent_messages_outlook(access_token, since, until, text_body=True, mailbox=None):
+    # authorization header
+    headers = {"Authorization": f"Bearer {access_token}"}
+    # ask Graph to convert HTML bodies to plain text server-side
+    if text_body:
+        headers["Prefer"] = 'outlook.body-content-type="text"'
+    # query to fetch sent messages in the window, trimmed to the fields we use
+    url = f"{GRAPH_URL}{mailbox_path(mailbox)}/mailFolders/sentitems/messages"
+    params = {
+        "$filter": f"sentDateTime ge {since.isoformat()}Z and sentDateTime le {until.isoformat()}Z",
+        "$select": MESSAGE_SELECT,
+        # newest first, so the latest message to each client is the one followed up
+        "$orderby": "sentDateTime desc",
+        "$top": GRAPH_PAGE_SIZE
+    }
+    # stream messages page by page, following @odata.nextLink
+    while url:
+        response = graph_request("GET", url, mailbox, headers=headers, params=params)
+        response.raise_for_status()
+        page = response.json()
+        for msg in page.get("value", []):
+            yield msg
+        # nextLink already carries the query parameters
+        url = page.get("@odata.nextLink")
+        params = None
+
+def parse_graph_time(value):
+    # Graph ISO 8601 timestamp as an epoch timestamp
+    return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+def parse_sent_time(msg):
+    # sentDateTime as an epoch timestamp
+    return parse_graph_time(msg["sentDateTime"])
+
+def sync_sent_messages_outlook(access_token, state, since, mailbox=None):
+    # bring the local message store up to date with a Graph delta query
+    key = mailbox_key(mailbox)
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Prefer": f'outlook.body-content-type="text", odata.maxpagesize={GRAPH_PAGE_SIZE}'
+    }
+    url = get_cursor(state, key)
+    params = None
+    if not url:
+        # first run: start a new delta round for the window
+        url = f"{GRAPH_URL}{mailbox_path(mailbox)}/mailFolders/sentitems/messages/delta"
+        params = {"$select": MESSAGE_SELECT, "$filter": f"receivedDateTime ge {since.isoformat()}Z"}
+    added = 0
+    while True:
+        response = graph_request("GET", url, mailbox, headers=headers, params=params)
+        if response.status_code == 410 and params is None and get_cursor(state, key) == url:
+            # delta token expired; start over with a full sync
+            set_cursor(state, key, "")
+            return sync_sent_messages_outlook(access_token, state, since, mailbox)
+        response.raise_for_status()
+        page = response.json()
+        changes = page.get("value", [])
+        # merge additions/updates and drop deleted messages
+        untrack_messages(state, key, [msg["id"] for msg in changes if "@removed" in msg])
+        upserts = [msg for msg in changes if "@removed" not in msg and msg.get("sentDateTime")]
+        track_messages(state, key, [(msg["id"], parse_sent_time(msg), msg) for msg in upserts])
+        added += len(upserts)
+        # follow nextLink until Graph hands back the deltaLink for next time
+        if "@odata.nextLink" in page:
+            url = page["@odata.nextLink"]
+            params = None
+            # checkpoint every page, so an interrupted sync resumes here instead of starting over
+            set_cursor(state, key, url)
+        else:
+            set_cursor(state, key, page["@odata.deltaLink"])
+            break
+    print(f"Synced {added} new or changed sent messages{f' for {mailbox}' if mailbox else ''}.")
+
+def parse_message_outlook(msg):
+    # get recipient email address
+    to_recipients = msg.get("toRecipients", [])
+    # bodies are requested as text, but convert any HTML that still comes through
+    body = msg.get("body", {})
+    content = body.get("content", "")
+    if body.get("contentType", "").lower() == "html":
+        content = html_to_text(content)
+    # get subject, recipient and body of email
+    return {
+        "id": msg["id"],
+        "thread_id": msg.get("conversationId"),
+        "sent_at": parse_sent_time(msg) if msg.get("sentDateTime") else 0,
+        "subject": msg.get("subject", ""),
+        "to": to_recipients[0]["emailAddress"]["address"] if to_recipients else "",
+        "body": content
+    }
+
+class OutlookProvider:
+    # Outlook adapter for the shared follow-up pipeline; leads go to Excel workbooks
+    def __init__(self, access_token, sent_messages, mailbox=None, leads=None):
+        self.access_token = access_token
+        self.sent_messages = sent_messages
+        self.mailbox = mailbox
+        self.name = mailbox_key(mailbox)
+        # emails handed to send() at a time
+        self.send_batch_size = GRAPH_BATCH_SIZE if GRAPH_BATCH_SENDS else 1
+        # lead rows are buffered and written once per workbook (shared by all mailboxes of a run)
+        self.leads = leads if leads is not None else ExcelLeadSink()
+        self.leads_target = LEADS_FILE
+        self.lost_leads_target = LOST_LEADS_FILE
+
+    def fetch_pages(self):
+        # one page per Graph page of messages
+        for chunk in chunked(self.sent_messages, GRAPH_PAGE_SIZE):
+            yield [parse_message_outlook(msg) for msg in chunk]
+
+    def find_replies(self, messages):
+        # one $batch call per 20 conversations
+        return find_replies_outlook(self.access_token, messages, self.mailbox)
+
+    def send(self, emails):
+        # send emails for the send scheduler, batched through Graph when enabled;
+        # one result per email: None if sent, else (status, Retry-After)
+        if GRAPH_BATCH_SENDS:
+            return send_emails_outlook_batch(self.access_token, emails, self.mailbox)
+        results = []
+        for email in emails:
+            try:
+                send_email_outlook(self.access_token, *email, mailbox=self.mailbox)
+                results.append(None)
+            except requests.HTTPError as error:
+                results.append((error.response.status_code, error.response.headers.get("Retry-After")))
+            except requests.RequestException:
+                # network error
+                results.append((0, None))
+        return results
+
+def list_group_members(access_token, group_id):
+    # IDs of the users in a group, following @odata.nextLink
+    headers = {"Authorization": f"Bearer {access_token}"}
+    url = f"{GRAPH_URL}/groups/{urllib.parse.quote(group_id)}/members/microsoft.graph.user"
+    params = {"$select": "id", "$top": 999}
+    while url:
+        response = graph_request("GET", url, headers=headers, params=params)
+        response.raise_for_status()
+        page = response.json()
+        for user in page.get("value", []):
+            yield user["id"]
+        url = page.get("@odata.nextLink")
+        params = None
+
+def resolve_mailboxes(access_token, mailboxes=OUTLOOK_MAILBOXES, group=OUTLOOK_MAILBOX_GROUP, shard=MAILBOX_SHARD):
+    # mailboxes this process handles, or None for the single signed-in mailbox (/me)
+    if not mailboxes and not group:
+        return None
+    found = list(mailboxes)
+    if group:
+        found += list(list_group_members(access_token, group))
+    found = list(dict.fromkeys(found))
+    if shard:
+        # consistent hashing: each host keeps the same mailboxes as long as the shard count is unchanged
+        index, count = (int(part) for part in shard.split("/"))
+        found = [mailbox for mailbox in found if shard_owner(mailbox, count) == index]
+    return found
+
+def follow_up_mailbox(access_token, cache, leads, outbox, now, mailbox=None, incremental=INCREMENTAL_SYNC):
+    # run the staged pipeline for one mailbox; returns the number of sent messages processed
+    two_days_ago = now - datetime.timedelta(days=2)
+    seven_days_ago = now - datetime.timedelta(days=7)
+    if incremental:
+        # fetch only what changed since the last run, then read the window from the local store
+        state = open_sync_state()
+        sync_sent_messages_outlook(access_token, state, seven_days_ago, mailbox)
+        sent_messages = tracked_in_window(
+            state,
+            mailbox_key(mailbox),
+            seven_days_ago.replace(tzinfo=datetime.timezone.utc).timestamp(),
+            two_days_ago.replace(tzinfo=datetime.timezone.utc).timestamp()
+        )
     else:
-        # load existing workbook
-        wb = openpyxl.load_workbook(filename)
-        ws = wb.active
-    # append new row to worksheet
-    ws.append(row)
-    # save workbook
-    wb.save(filename)
-
-def follow_up_logic_outlook(access_token):
+        sent_messages = fetch_sent_messages_outlook(access_token, seven_days_ago, two_days_ago, mailbox=mailbox)
+    provider = OutlookProvider(access_token, sent_messages, mailbox, leads)
+    try:
+        # fetch, classify, record and send overlap in a staged pipeline
+        return run_pipeline(provider, cache, now.date(), outbox)
+    finally:
+        if incremental:
+            state.close()
+
+def follow_up_mailboxes(access_token, cache, leads, outbox, now, mailboxes, incremental=INCREMENTAL_SYNC, workers=MAILBOX_WORKERS):
+    # process mailboxes in parallel; a slow or failing mailbox doesn't hold up the others
+    def process(mailbox):
+        started = time.perf_counter()
+        try:
+            processed = follow_up_mailbox(access_token, cache, leads, outbox, now, mailbox, incremental)
+        except Exception as error:
+            record_mailbox(mailbox, 0, time.perf_counter() - started, error)
+            print(f"⚠️ Mailbox {mailbox} failed: {error}")
+            return 0
+        record_mailbox(mailbox, processed, time.perf_counter() - started)
+        print(f"📬 {mailbox}: processed {processed} sent messages.")
+        return processed
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return sum(pool.map(process, mailboxes))
+
+def follow_up_logic_outlook(access_token, incremental=INCREMENTAL_SYNC, mailboxes=None, workers=MAILBOX_WORKERS):
     # current UTC time
     now = datetime.datetime.utcnow()
-    # two days ago
-    two_days_ago = now - datetime.timedelta(days=2)
-    # seven days ago
-    seven_days_ago = now - datetime.timedelta(days=7)
+    # per-run timings and call counters
+    start_run()
 
-    # authorization header
-    headers = {"Authorization": f"Bearer {access_token}"}
-    # query to fetch sent messages between 2-7 days ago
-    query = (
-        f"https://graph.microsoft.com/v1.0/me/mailFolders/sentitems/messages"
-        f"?$filter=sentDateTime ge {seven_days_ago.isoformat()}Z and sentDateTime le {two_days_ago.isoformat()}Z"
-        f"&$top=50"
-    )
-    # get messages from Outlook API
-    response = requests.get(query, headers=headers)
-    response.raise_for_status()
-    messages = response.json().get("value", [])
-
-    print(f"Found {len(messages)} sent messages between 2–7 days ago.")
-
-    for msg in messages:
-        # get subject of email
-        subject = msg.get("subject", "")
-        # get recipient email address
-        to_recipients = msg.get("toRecipients", [])
-        to = to_recipients[0]["emailAddress"]["address"] if to_recipients else ""
-        # get email body
-        body = msg.get("body", {}).get("content", "")
-
-        # classify if email is a business proposal
-        classify_prompt = f"Is the following email a business proposal or pitch? Reply only 'Yes' or 'No'.\n\n{body}"
-        result = ask_deepseek(classify_prompt).strip().lower()
-
-        if "yes" in result:
-            # save as open lead in Excel
-            append_to_excel(LEADS_FILE, [now.date(), to, subject, "Open Lead"])
-
-            # check if client rejected lead
-            if "we went with another company" in body.lower():
-                # save lost lead in Excel
-                append_to_excel(LOST_LEADS_FILE, [now.date(), to, subject, "Lost Lead"])
-                # send sympathetic email
-                sympathetic_msg = "Thank you for considering us. We wish you success with your chosen provider."
-                send_email_outlook(access_token, to, f"RE: {subject}", sympathetic_msg)
-            else:
-                # generate polite follow-up via DeepSeek
-                followup_prompt = f"""Write a short, polite follow-up email paragraph to a client based on this previous message:
-\"\"\"{body}\"\"\""""
-                follow_up_body = ask_deepseek(followup_prompt).strip()
-                # send follow-up email
-                send_email_outlook(access_token, to, f"RE: {subject}", follow_up_body)
+    # verdict cache shared across daily runs
+    cache = open_cache()
+    # lead rows from every mailbox go to the same workbooks
+    leads = ExcelLeadSink()
+    # durable queue of follow-ups; anything left over from an earlier run is sent first
+    outbox = open_outbox()
+    try:
+        if mailboxes is None:
+            processed = follow_up_mailbox(access_token, cache, leads, outbox, now, incremental=incremental)
+        else:
+            processed = follow_up_mailboxes(access_token, cache, leads, outbox, now, mailboxes, incremental, workers)
+    finally:
+        # write collected leads even if the run fails part way
+        leads.flush()
+        cache.close()
+        outbox.close()
+        # run summary for dashboards, also written for failed runs
+        summary = write_summary()
 
-if __name__ == "__main__":
+    print(f"Processed {processed} sent messages between 2–7 days ago{f' in {len(mailboxes)} mailboxes' if mailboxes is not None else ''}.")
+    report_run(summary)
+
+def run_daemon(interval=DAEMON_INTERVAL_SECONDS):
+    # one MSAL client (and token cache) for the whole process
+    app = create_outlook_app()
+
+    def cycle():
+        # one app token for every mailbox of the cycle
+        token = authenticate_outlook(app)
+        follow_up_logic_outlook(token, mailboxes=resolve_mailboxes(token))
+
+    run_forever(cycle, interval)
+
+def run(daemon=False, interval=DAEMON_INTERVAL_SECONDS):
+    if daemon:
+        run_daemon(interval)
+        return
     # authenticate and get access token
     token = authenticate_outlook()
-    # run follow-up logic
-    follow_up_logic_outlook(token)
+    # run follow-up logic (profiled if PROFILE_OUTPUT is set)
+    with profiled():
+        follow_up_logic_outlook(token, mailboxes=resolve_mailboxes(token))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Outlook follow-up automation")
+    parser.add_argument("--daemon", action="store_true", help="keep running and repeat the follow-up cycle")
+    parser.add_argument("--interval", type=int, default=DAEMON_INTERVAL_SECONDS, help="seconds between cycles in daemon mode")
+    args = parser.parse_args()
+    run(args.daemon, args.interval)
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+# JSON run summary (set to empty to disable)
+METRICS_JSON = os.getenv("METRICS_JSON", "run_metrics.json")
+# Prometheus textfile-collector output, e.g. /var/lib/node_exporter/textfile/email_automator.prom
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "")
+# write merged cProfile stats for the whole run (all threads) to this file
+PROFILE_OUTPUT = os.getenv("PROFILE_OUTPUT", "")
+
+lock = threading.Lock()
+# per external endpoint: calls, errors, retries and time spent
+endpoints = {}
+# per pipeline stage: runs and time spent
+stages = {}
+# DeepSeek token usage
+tokens = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+# messages skipped before classification, by reason (e.g. the client already replied)
+skipped = {}
+# queued follow-ups by outcome: sent, retried (throttled or failed, rescheduled) and failed
+sends = {}
+# per mailbox in multi-mailbox runs: messages processed, time spent and any error
+mailboxes = {}
+# process startup phases (e.g. importing the provider); kept across runs in daemon mode
+startup = {}
+started_at = time.time()
+
+def reset():
+    # start a fresh run
+    global started_at
+    with lock:
+        endpoints.clear()
+        stages.clear()
+        skipped.clear()
+        sends.clear()
+        mailboxes.clear()
+        for key in tokens:
+            tokens[key] = 0
+        started_at = time.time()
+
+def record_call(endpoint, seconds, error=False):
+    with lock:
+        entry = endpoints.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["calls"] += 1
+        entry["errors"] += int(error)
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+def record_retry(endpoint):
+    with lock:
+        entry = endpoints.setdefault(endpoint, {"calls": 0, "errors": 0, "retries": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["retries"] += 1
+
+def record_stage(stage, seconds):
+    with lock:
+        entry = stages.setdefault(stage, {"runs": 0, "seconds": 0.0, "max_seconds": 0.0})
+        entry["runs"] += 1
+        entry["seconds"] += seconds
+        entry["max_seconds"] = max(entry["max_seconds"], seconds)
+
+def record_skipped(reason, count=1):
+    with lock:
+        skipped[reason] = skipped.get(reason, 0) + count
+
+def record_send(outcome, count=1):
+    with lock:
+        sends[outcome] = sends.get(outcome, 0) + count
+
+def record_mailbox(mailbox, processed, seconds, error=None):
+    with lock:
+        mailboxes[mailbox] = {"processed": processed, "seconds": round(seconds, 3), "error": str(error) if error else None}
+
+def record_startup(phase, seconds):
+    with lock:
+        startup[phase] = seconds
+
+def record_usage(usage):
+    # add the `usage` block of a DeepSeek response
+    with lock:
+        for key in tokens:
+            tokens[key] += int((usage or {}).get(key, 0))
+
+@contextmanager
+def timed_call(endpoint):
+    # time an external call, counting it as an error if it raises
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        record_call(endpoint, time.perf_counter() - start, error=True)
+        raise
+    record_call(endpoint, time.perf_counter() - start)
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def summary():
+    with lock:
+        return {
+            "started_at": started_at,
+            "duration_seconds": round(time.time() - started_at, 3),
+            "endpoints": {name: dict(entry) for name, entry in endpoints.items()},
+            "stages": {name: dict(entry) for name, entry in stages.items()},
+            "deepseek_tokens": dict(tokens),
+            "skipped_messages": dict(skipped),
+            "sends": dict(sends),
+            "mailboxes": {name: dict(entry) for name, entry in mailboxes.items()},
+            "startup_seconds": dict(startup)
+        }
+
+def prometheus_text(data):
+    # render the summary in the Prometheus text exposition format
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(f"# HELP email_automator_{name} {help_text}")
+        lines.append(f"# TYPE email_automator_{name} gauge")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{val}"' for key, val in labels.items())
+            lines.append(f"email_automator_{name}{{{label_text}}} {value}" if label_text else f"email_automator_{name} {value}")
+
+    # every value describes the last run, so they are all gauges
+    endpoint_items = sorted(data["endpoints"].items())
+    stage_items = sorted(data["stages"].items())
+    metric("last_run_calls", "External API calls in the last run.", [({"endpoint": n}, e["calls"]) for n, e in endpoint_items])
+    metric("last_run_errors", "Failed external API calls in the last run.", [({"endpoint": n}, e["errors"]) for n, e in endpoint_items])
+    metric("last_run_retries", "Retried external API calls in the last run.", [({"endpoint": n}, e["retries"]) for n, e in endpoint_items])
+    metric("last_run_call_seconds", "Time spent in external API calls in the last run.", [({"endpoint": n}, round(e["seconds"], 6)) for n, e in endpoint_items])
+    metric("last_run_stage_seconds", "Time spent in each pipeline stage in the last run.", [({"stage": n}, round(e["seconds"], 6)) for n, e in stage_items])
+    metric("last_run_deepseek_tokens", "DeepSeek tokens used in the last run.", [({"kind": k}, v) for k, v in sorted(data["deepseek_tokens"].items())])
+    metric("last_run_skipped_messages", "Messages skipped before classification in the last run.", [({"reason": k}, v) for k, v in sorted(data["skipped_messages"].items())])
+    metric("last_run_sends", "Queued follow-ups by send outcome in the last run.", [({"outcome": k}, v) for k, v in sorted(data["sends"].items())])
+    if data["mailboxes"]:
+        mailbox_items = sorted(data["mailboxes"].items())
+        metric("last_run_mailbox_processed", "Sent messages processed per mailbox in the last run.", [({"mailbox": n}, e["processed"]) for n, e in mailbox_items])
+        metric("last_run_mailbox_seconds", "Time spent on each mailbox in the last run.", [({"mailbox": n}, e["seconds"]) for n, e in mailbox_items])
+        metric("last_run_mailbox_failed", "1 if the mailbox failed in the last run.", [({"mailbox": n}, int(e["error"] is not None)) for n, e in mailbox_items])
+    if data["startup_seconds"]:
+        metric("startup_seconds", "Time spent in each startup phase of the process.", [({"phase": k}, round(v, 6)) for k, v in sorted(data["startup_seconds"].items())])
+    metric("last_run_duration_seconds", "Duration of the last run.", [({}, data["duration_seconds"])])
+    metric("last_run_timestamp_seconds", "Start time of the last run.", [({}, round(data["started_at"], 3))])
+    return "\n".join(lines) + "\n"
+
+def write_atomic(path, text):
+    # the textfile collector may read at any time, so never expose a half-written file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+def write_summary(json_path=METRICS_JSON, prom_path=METRICS_PROM_FILE):
+    # write the run summary as JSON and/or a Prometheus textfile
+    data = summary()
+    if json_path:
+        write_atomic(json_path, json.dumps(data, indent=2))
+    if prom_path:
+        write_atomic(prom_path, prometheus_text(data))
+    return data
+
+@contextmanager
+def profiled(output=PROFILE_OUTPUT):
+    # optional cProfile of the whole run, including pipeline worker threads
+    if not output:
+        yield
+        return
+    profiles = []
+
+    def start_thread_profile(*args):
+        # runs once at the start of every new thread, then hands over to cProfile
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        with lock:
+            profiles.append(profile)
+        profile.enable()
+
+    main_profile = cProfile.Profile()
+    threading.setprofile(start_thread_profile)
+    main_profile.enable()
+    try:
+        yield
+    finally:
+        main_profile.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(main_profile)
+        for profile in profiles:
+            stats.add(profile)
+        stats.dump_stats(output)
+        print(f"📈 Profile written to {output}")
@@ -0,0 +1,121 @@
+import os
+import re
+import hashlib
+import threading
+from array import array
+from normalize import message_text
+
+# set to 0 to classify near-duplicate emails separately
+NEAR_DUPLICATE_ENABLED = os.getenv("NEAR_DUPLICATE_ENABLED", "1") != "0"
+# estimated Jaccard similarity (of word 3-grams) at which an email reuses another email's verdict;
+# each edited word changes three 3-grams, so a short template with a few edits scores about 0.7-0.8
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0.7))
+# set to 1 to also reuse follow-up drafts, at a stricter similarity; drafts name the client and repeat
+# their details, so a draft is only reused for the recipient it was written for
+NEAR_DUPLICATE_DRAFTS = os.getenv("NEAR_DUPLICATE_DRAFTS", "0") == "1"
+NEAR_DUPLICATE_DRAFT_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_DRAFT_THRESHOLD", 0.9))
+
+# MinHash signature length, split into LSH bands of ROWS values; with 16 x 4, pairs at
+# similarity 0.7 share a band 99% of the time and pairs at 0.3 only 12% of the time
+NUM_HASHES = 64
+ROWS = 4
+BANDS = NUM_HASHES // ROWS
+# tags values borrowed by empty bins with how far they were borrowed from
+BORROW_OFFSET = 1 << 58
+
+# lookups and hits during this process, for hit-rate reporting
+stats = {"verdict_lookups": 0, "verdict_hits": 0, "draft_lookups": 0, "draft_hits": 0}
+stats_lock = threading.Lock()
+
+def stable_hash(text):
+    # signed 64-bit hash that is the same in every process (unlike hash()) and fits an SQLite integer
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+def shingles(text):
+    # overlapping word 3-grams; short texts fall back to single words
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 3:
+        return set(words)
+    return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+def signature(text):
+    # MinHash signature of the text, or None if it has no words; one-permutation hashing
+    # (each 3-gram is hashed once into one of NUM_HASHES bins) instead of NUM_HASHES hash functions
+    bins = [None] * NUM_HASHES
+    for shingle in shingles(text):
+        h = stable_hash(shingle) & 0xFFFFFFFFFFFFFFFF
+        value = h >> 6
+        if bins[h % NUM_HASHES] is None or value < bins[h % NUM_HASHES]:
+            bins[h % NUM_HASHES] = value
+    if all(value is None for value in bins):
+        return None
+    # densify: an empty bin borrows the value of the next filled bin, so short texts still have a full signature
+    result = []
+    for i in range(NUM_HASHES):
+        distance = 0
+        while bins[(i + distance) % NUM_HASHES] is None:
+            distance += 1
+        result.append(bins[(i + distance) % NUM_HASHES] + distance * BORROW_OFFSET)
+    return tuple(result)
+
+def message_signature(message):
+    # signature of a message's normalised body, computed once
+    if "signature" not in message:
+        message["signature"] = signature(message_text(message))
+    return message["signature"]
+
+def band_keys(sig):
+    # one LSH bucket per band; near-duplicates share at least one bucket
+    return [stable_hash(f"{band}:{sig[band * ROWS:(band + 1) * ROWS]}") for band in range(BANDS)]
+
+def similarity(a, b):
+    # estimated Jaccard similarity of the two texts
+    return sum(x == y for x, y in zip(a, b)) / NUM_HASHES
+
+def pack(sig):
+    return array("Q", sig).tobytes()
+
+def unpack(blob):
+    values = array("Q")
+    values.frombytes(blob)
+    return tuple(values)
+
+def group_near_duplicates(signatures, threshold, groups=None):
+    # greedy grouping: for each signature, the index of the first earlier one (in the same group, if given)
+    # it matches, or its own
+    buckets = {}
+    leaders = []
+    for i, sig in enumerate(signatures):
+        leader = i
+        if sig is not None:
+            keys = band_keys(sig)
+            candidates = {j for key in keys for j in buckets.get(key, ())}
+            for j in sorted(candidates):
+                if (groups is None or groups[j] == groups[i]) and similarity(sig, signatures[j]) >= threshold:
+                    leader = j
+                    break
+            if leader == i:
+                for key in keys:
+                    buckets.setdefault(key, []).append(i)
+        leaders.append(leader)
+    return leaders
+
+def record(kind, lookups, hits):
+    # pipeline workers classify pages in parallel
+    with stats_lock:
+        stats[f"{kind}_lookups"] += lookups
+        stats[f"{kind}_hits"] += hits
+
+def reset_stats():
+    # start a fresh run
+    with stats_lock:
+        for key in stats:
+            stats[key] = 0
+
+def format_stats():
+    with stats_lock:
+        verdicts = f"{stats['verdict_hits']}/{stats['verdict_lookups']} verdicts"
+        if stats["verdict_lookups"]:
+            verdicts += f" ({stats['verdict_hits'] / stats['verdict_lookups']:.0%})"
+        drafts = f", {stats['draft_hits']}/{stats['draft_lookups']} drafts" if stats["draft_lookups"] else ""
+    return f"Near-duplicate index: reused {verdicts}{drafts}."
@@ -0,0 +1,92 @@
+import os
+import re
+from html import unescape
+from html.parser import HTMLParser
+
+# normalised bodies are cut to roughly this many tokens before prompting (0 disables truncation)
+BODY_MAX_TOKENS = int(os.getenv("BODY_MAX_TOKENS", 750))
+# crude token estimate used for budgeting
+CHARS_PER_TOKEN = 4
+
+# the start of quoted history in replies and forwards; everything from here on is dropped
+QUOTE_MARKERS = [
+    re.compile(r"^On .{0,200}(\n.{0,200})?wrote:\s*$", re.MULTILINE),
+    re.compile(r"^-{2,}\s*(Original Message|Forwarded message)\s*-{2,}", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^_{10,}\s*$", re.MULTILINE),
+    re.compile(r"^From: .+\n(Sent|Date): ", re.MULTILINE),
+]
+# the start of a signature or legal footer
+FOOTER_MARKERS = [
+    re.compile(r"^-- ?$", re.MULTILINE),
+    re.compile(r"^Sent from my \w+", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^(CONFIDENTIALITY NOTICE|DISCLAIMER)\b", re.MULTILINE | re.IGNORECASE),
+    re.compile(r"^This (e-?mail|message)( and any attachments)? (is|are|may be) (confidential|intended)", re.MULTILINE | re.IGNORECASE),
+]
+# HTML elements that start a new line, and ones whose content is never shown
+BLOCK_TAGS = {"br", "p", "div", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "table"}
+HIDDEN_TAGS = {"script", "style", "head", "title"}
+
+class TextExtractor(HTMLParser):
+    # collect the visible text of an HTML document
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.hidden = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HIDDEN_TAGS:
+            self.hidden += 1
+        elif tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in HIDDEN_TAGS:
+            self.hidden = max(0, self.hidden - 1)
+        elif tag in BLOCK_TAGS:
+            self.chunks.append("\n")
+
+    def handle_data(self, data):
+        if not self.hidden:
+            self.chunks.append(data)
+
+def html_to_text(html):
+    # convert an HTML body to plain text, one line per block element
+    parser = TextExtractor()
+    try:
+        parser.feed(html)
+        parser.close()
+        text = "".join(parser.chunks)
+    except Exception:
+        # malformed markup: drop the tags rather than failing the message
+        text = unescape(re.sub(r"<[^>]+>", " ", html))
+    lines = (re.sub(r"[ \t\xa0]+", " ", line).strip() for line in text.splitlines())
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def cut_at_first(text, markers):
+    # drop everything from the earliest marker match onwards
+    starts = [match.start() for match in (marker.search(text) for marker in markers) if match]
+    return text[:min(starts)] if starts else text
+
+def truncate_tokens(text, max_tokens=BODY_MAX_TOKENS):
+    # cut text to roughly max_tokens, on a word boundary
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if not max_tokens or len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    return cut[:cut.rfind(" ")] if " " in cut else cut
+
+def normalize_body(body, max_tokens=BODY_MAX_TOKENS):
+    # text worth prompting with: no quoted history, signature or disclaimer, within the token budget
+    text = body.replace("\r\n", "\n")
+    text = cut_at_first(text, QUOTE_MARKERS)
+    # "> " lines left over from inline replies
+    text = "\n".join(line for line in text.split("\n") if not line.lstrip().startswith(">"))
+    text = cut_at_first(text, FOOTER_MARKERS).strip()
+    # never strip a message down to nothing
+    return truncate_tokens(text or body.strip(), max_tokens)
+
+def message_text(message):
+    # normalised body of a message dict, computed once and kept on the message for every prompt
+    if "text" not in message:
+        message["text"] = normalize_body(message["body"])
+    return message["text"]
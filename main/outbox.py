@@ -0,0 +1,216 @@
+import os
+import time
+import random
+import sqlite3
+import threading
+from deepseek import TokenBucket
+from metrics import record_send
+
+# SQLite file holding follow-ups waiting to be sent, so a crash or quota stop never loses them
+OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.db")
+# sends per minute per account (Exchange Online allows 30 messages a minute per mailbox)
+SEND_RATE_PER_MINUTE = float(os.getenv("SEND_RATE_PER_MINUTE", 30))
+# sends per account in any 24 hours (Gmail allows 500 for consumer and 2000 for Workspace accounts)
+SEND_DAILY_QUOTA = int(os.getenv("SEND_DAILY_QUOTA", 500))
+# attempts per email before it is marked as failed
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", 5))
+# backoff for throttled or failed sends without a Retry-After
+SEND_BACKOFF_BASE = float(os.getenv("SEND_BACKOFF_BASE", 5))
+SEND_BACKOFF_MAX = float(os.getenv("SEND_BACKOFF_MAX", 900))
+# at the end of a run, wait at most this long for deferred sends; later ones are left for the next run
+SEND_DRAIN_WAIT_SECONDS = float(os.getenv("SEND_DRAIN_WAIT_SECONDS", 60))
+# how long an account is paused after its provider reports the daily sending limit
+SEND_DAILY_LIMIT_PAUSE_SECONDS = int(os.getenv("SEND_DAILY_LIMIT_PAUSE_SECONDS", 3600))
+# sent and failed emails are kept this long (at least a day, for the daily quota)
+OUTBOX_RETENTION_SECONDS = int(os.getenv("OUTBOX_RETENTION_SECONDS", 7 * 24 * 3600))
+
+# network errors are reported as status 0
+RETRYABLE_STATUS = {0, 408, 429, 500, 502, 503, 504}
+# status providers report when the account's daily sending limit is used up
+DAILY_LIMIT = "daily_limit"
+
+# the connection is shared by every account's scheduler and the pipeline, so access is serialised
+lock = threading.Lock()
+
+def open_outbox(path=OUTBOX_DB):
+    # open (or create) the outbox database
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # every send commits twice; WAL keeps that cheap and still survives a process crash
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS outbox ("
+        " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+        " account TEXT NOT NULL,"
+        " recipient TEXT NOT NULL,"
+        " subject TEXT NOT NULL,"
+        " body TEXT NOT NULL,"
+        " status TEXT NOT NULL,"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " not_before REAL NOT NULL,"
+        " created_at REAL NOT NULL,"
+        " sent_at REAL,"
+        " last_error TEXT)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (account, status, not_before)")
+    # sends interrupted by a crash go out again (at-least-once)
+    conn.execute("UPDATE outbox SET status = 'pending' WHERE status = 'sending'")
+    conn.execute(
+        "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND created_at < ?",
+        (time.time() - OUTBOX_RETENTION_SECONDS,)
+    )
+    conn.commit()
+    return conn
+
+def enqueue(conn, account, emails):
+    # durably queue (to, subject, body) emails for the account, in one transaction
+    now = time.time()
+    with lock:
+        conn.executemany(
+            "INSERT INTO outbox (account, recipient, subject, body, status, not_before, created_at)"
+            " VALUES (?, ?, ?, ?, 'pending', ?, ?)",
+            [(account, to, subject, body, now, now) for to, subject, body in emails]
+        )
+        conn.commit()
+
+def claim_due(conn, account, limit):
+    # mark up to `limit` due emails as being sent and return them as (id, to, subject, body, attempts)
+    with lock:
+        rows = conn.execute(
+            "SELECT id, recipient, subject, body, attempts FROM outbox"
+            " WHERE account = ? AND status = 'pending' AND not_before <= ? ORDER BY not_before, id LIMIT ?",
+            (account, time.time(), limit)
+        ).fetchall()
+        conn.executemany("UPDATE outbox SET status = 'sending' WHERE id = ?", [(row[0],) for row in rows])
+        conn.commit()
+    return rows
+
+def next_due_at(conn, account):
+    # when the account's next pending email becomes due, or None if nothing is pending
+    with lock:
+        row = conn.execute(
+            "SELECT MIN(not_before) FROM outbox WHERE account = ? AND status = 'pending'", (account,)
+        ).fetchone()
+    return row[0]
+
+def sent_since(conn, account, since):
+    # emails sent for the account since the epoch timestamp
+    with lock:
+        return conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE account = ? AND status = 'sent' AND sent_at >= ?", (account, since)
+        ).fetchone()[0]
+
+def record_results(conn, updates):
+    # apply (id, status, not_before, error, attempts used) updates in one transaction
+    now = time.time()
+    with lock:
+        conn.executemany(
+            "UPDATE outbox SET status = ?, attempts = attempts + ?, not_before = ?, last_error = ?,"
+            " sent_at = CASE WHEN ? = 'sent' THEN ? ELSE sent_at END WHERE id = ?",
+            [(status, used, not_before, error, status, now, item_id) for item_id, status, not_before, error, used in updates]
+        )
+        conn.commit()
+
+def defer_account(conn, account, until):
+    # hold back all of the account's pending emails until the epoch timestamp, across runs too
+    with lock:
+        conn.execute(
+            "UPDATE outbox SET not_before = MAX(not_before, ?) WHERE account = ? AND status = 'pending'", (until, account)
+        )
+        conn.commit()
+
+def retry_after_seconds(attempts, retry_after=None):
+    # honour Retry-After (in seconds) when given, otherwise exponential backoff with jitter
+    if retry_after:
+        try:
+            return min(float(retry_after), SEND_BACKOFF_MAX)
+        except ValueError:
+            pass
+    return min(SEND_BACKOFF_BASE * 2 ** attempts, SEND_BACKOFF_MAX) * random.uniform(0.5, 1)
+
+class SendScheduler:
+    # drains one account's outbox within its rate and daily quota, slowing down when throttled
+    def __init__(self, conn, account, send, batch_size=1,
+                 rate_per_minute=SEND_RATE_PER_MINUTE, daily_quota=SEND_DAILY_QUOTA):
+        self.conn = conn
+        self.account = account
+        # send(emails) returns one result per email: None if sent, else (status, retry_after)
+        self.send = send
+        self.batch_size = batch_size
+        self.max_rate = rate_per_minute / 60
+        self.daily_quota = daily_quota
+        self.bucket = TokenBucket(self.max_rate, max(1, batch_size))
+        self.paused_until = 0
+
+    def quota_left(self):
+        return self.daily_quota - sent_since(self.conn, self.account, time.time() - 24 * 3600)
+
+    def run(self, producers_done, stop):
+        # send due emails until producers are done and nothing is due soon, or stop is set
+        while not stop.is_set():
+            quota = self.quota_left()
+            if quota <= 0:
+                print(f"⏸️ Daily send quota reached for {self.account}; remaining follow-ups stay queued.")
+                return
+            wait = self.paused_until - time.time()
+            if wait > 0:
+                stop.wait(min(wait, 1))
+                continue
+            items = claim_due(self.conn, self.account, min(self.batch_size, quota))
+            if not items:
+                due_at = next_due_at(self.conn, self.account)
+                if producers_done.is_set() and (due_at is None or due_at - time.time() > SEND_DRAIN_WAIT_SECONDS):
+                    return
+                stop.wait(0.05 if due_at is None else min(max(due_at - time.time(), 0.05), 1))
+                continue
+            for _ in items:
+                self.bucket.acquire()
+            if self.deliver(items):
+                print(f"⏸️ {self.account} reached its provider's daily sending limit; remaining follow-ups stay queued.")
+                return
+
+    def deliver(self, items):
+        # send claimed emails and record what happened to each; returns True if the daily limit was hit
+        try:
+            results = self.send([(to, subject, body) for _, to, subject, body, _ in items])
+        except Exception as error:
+            # the whole call failed; treat every email as a retryable error
+            print(f"⚠️ Sending for {self.account} failed: {error}")
+            results = [(0, None)] * len(items)
+        now = time.time()
+        updates = []
+        throttled = []
+        limited = False
+        for (item_id, to, _, _, attempts), result in zip(items, results):
+            if result is None:
+                updates.append((item_id, "sent", now, None, 1))
+                record_send("sent")
+                continue
+            status, retry_after = result
+            if status == DAILY_LIMIT:
+                # not the email's fault: queue it again without using up an attempt
+                updates.append((item_id, "pending", now + SEND_DAILY_LIMIT_PAUSE_SECONDS, "daily limit", 0))
+                record_send("retried")
+                limited = True
+            elif status in RETRYABLE_STATUS and attempts + 1 < SEND_MAX_ATTEMPTS:
+                delay = retry_after_seconds(attempts, retry_after)
+                updates.append((item_id, "pending", now + delay, f"status {status}", 1))
+                record_send("retried")
+                if status == 429:
+                    throttled.append(delay)
+            else:
+                print(f"⚠️ Giving up on follow-up to {to} (status {status}).")
+                updates.append((item_id, "failed", now, f"status {status}", 1))
+                record_send("failed")
+        record_results(self.conn, updates)
+        if limited:
+            defer_account(self.conn, self.account, now + SEND_DAILY_LIMIT_PAUSE_SECONDS)
+            return True
+        if throttled:
+            # multiplicative decrease: pause the account and halve its send rate
+            self.paused_until = now + max(throttled)
+            self.bucket.rate = max(self.bucket.rate / 2, self.max_rate / 64)
+        elif all(result is None for result in results):
+            # additive increase back towards the configured rate
+            self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 10)
+        return False
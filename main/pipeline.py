@@ -0,0 +1,333 @@
+import os
+import time
+import queue
+import threading
+from email.utils import getaddresses
+from classification_cache import (
+    REPLY_CACHE_TTL_SECONDS, cached_classify_many, get_recent_follow_ups, get_thread_replies,
+    near_duplicate_drafts, put_follow_ups, put_thread_replies
+)
+from classifier import classify_emails
+from deepseek import ask_deepseek, map_concurrently
+from metrics import record_skipped, reset as reset_metrics, timed_stage
+from near_duplicates import (
+    NEAR_DUPLICATE_DRAFTS, format_stats as format_near_duplicate_stats, reset_stats as reset_near_duplicate_stats
+)
+from normalize import message_text
+from outbox import SendScheduler, enqueue
+from prefilter import format_stats as format_prefilter_stats, reset_stats as reset_prefilter_stats
+
+# pages buffered between stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 2))
+# pages classified at the same time (each page already runs its DeepSeek calls concurrently)
+PIPELINE_CLASSIFY_WORKERS = int(os.getenv("PIPELINE_CLASSIFY_WORKERS", 2))
+# set to 0 to follow up without checking whether the client already replied
+REPLY_CHECK_ENABLED = os.getenv("REPLY_CHECK_ENABLED", "1") != "0"
+# a recipient gets at most one follow-up in this period (default 5 days, the length of the 2-7 day window)
+FOLLOW_UP_COOLDOWN_SECONDS = int(os.getenv("FOLLOW_UP_COOLDOWN_SECONDS", 5 * 24 * 3600))
+
+# marks the end of a stage's input
+DONE = object()
+
+SYMPATHETIC_MSG = "Thank you for considering us. We wish you success with your chosen provider."
+
+def generate_follow_up(body):
+    # generate polite follow-up via DeepSeek
+    followup_prompt = f"""Write a short, polite follow-up email paragraph to a client based on this previous message:
+\"\"\"{body}\"\"\""""
+    return ask_deepseek(followup_prompt).strip()
+
+def generate_follow_ups(messages):
+    # one follow-up per message, generated concurrently
+    return map_concurrently(generate_follow_up, [message_text(m) for m in messages])
+
+def is_lost(message):
+    # check if client rejected us
+    return "we went with another company" in message["body"].lower()
+
+def drop_answered(cache, provider, messages):
+    # drop messages whose thread got a reply after they were sent, looking up unknown or stale threads in bulk
+    now = time.time()
+    known = get_thread_replies(cache, provider.name, list({m["thread_id"] for m in messages if m.get("thread_id")}))
+
+    def answered(m, last_reply_at):
+        return last_reply_at is not None and last_reply_at > m.get("sent_at", 0)
+
+    stale = []
+    for m in messages:
+        last_reply_at, checked_at = known.get(m.get("thread_id"), (None, 0))
+        # a reply newer than the message settles it; otherwise only trust a recent check
+        if m.get("thread_id") and not answered(m, last_reply_at) and checked_at < now - REPLY_CACHE_TTL_SECONDS:
+            stale.append(m)
+    unknown = set()
+    if stale:
+        replies = provider.find_replies(stale)
+        put_thread_replies(cache, provider.name, replies)
+        known.update((thread_id, (last_reply_at, now)) for thread_id, last_reply_at in replies.items())
+        # threads that couldn't be looked up are skipped this run rather than risk following up on a reply;
+        # nothing is cached for them, so the next run looks them up again
+        unknown = {m["thread_id"] for m in stale if m["thread_id"] not in replies}
+    remaining = []
+    for m in messages:
+        if m.get("thread_id") in unknown:
+            record_skipped("reply_unknown")
+        elif answered(m, known.get(m.get("thread_id"), (None, 0))[0]):
+            record_skipped("answered")
+        else:
+            remaining.append(m)
+    return remaining
+
+def recipient_key(to):
+    # normalised recipient list, so "Ann <ann@x.com>" and "ann@x.com" match
+    return ",".join(sorted({address.lower() for _, address in getaddresses([to]) if address})) or to
+
+def newest_first(messages):
+    return sorted(messages, key=lambda m: m.get("sent_at", 0), reverse=True)
+
+def collapse(messages):
+    # keep only the most recent message per thread; other threads to the same client are
+    # still classified, since the newest message to a client may not be the proposal
+    seen = set()
+    kept = []
+    for m in newest_first(messages):
+        if not m.get("thread_id") or m["thread_id"] not in seen:
+            kept.append(m)
+        seen.add(m.get("thread_id"))
+    if len(kept) < len(messages):
+        record_skipped("duplicate", len(messages) - len(kept))
+    return kept
+
+def drop_cooling(cache, provider, messages):
+    # drop recipients still in their follow-up cooldown, before classifying them
+    keys = [recipient_key(m["to"]) for m in messages]
+    cooling = get_recent_follow_ups(cache, provider.name, list(set(keys)), time.time() - FOLLOW_UP_COOLDOWN_SECONDS)
+    kept = [m for m, key in zip(messages, keys) if key not in cooling]
+    if len(kept) < len(messages):
+        record_skipped("cooldown", len(messages) - len(kept))
+    return kept
+
+class RecipientClaims:
+    # recipients given a follow-up in this run; pages claim them in fetch order, and every
+    # provider fetches newest first, so the newest proposal to each client is the one kept
+    def __init__(self, stop):
+        self.claimed = set()
+        self.next_page = 0
+        self.condition = threading.Condition()
+        self.stop = stop
+
+    def claim(self, page_number, keys):
+        # wait for the earlier pages, then return which of the keys this page gets
+        with self.condition:
+            while self.next_page != page_number and not self.stop.is_set():
+                self.condition.wait(0.1)
+            granted = []
+            for key in keys:
+                granted.append(key not in self.claimed)
+                self.claimed.add(key)
+            self.next_page += 1
+            self.condition.notify_all()
+        return granted
+
+def one_per_recipient(proposals, claims=None, page_number=0):
+    # the newest proposal per recipient, and only for recipients not handled by an earlier page
+    proposals = newest_first(proposals)
+    keys = [recipient_key(m["to"]) for m in proposals]
+    if claims is None:
+        granted = [key not in keys[:i] for i, key in enumerate(keys)]
+    else:
+        granted = claims.claim(page_number, keys)
+    kept = [m for m, ok in zip(proposals, granted) if ok]
+    if len(kept) < len(proposals):
+        record_skipped("duplicate", len(proposals) - len(kept))
+    return kept
+
+def process_page(cache, messages, provider=None, claims=None, page_number=0):
+    try:
+        return classify_page(cache, messages, provider, claims, page_number)
+    finally:
+        if claims is not None and claims.next_page <= page_number:
+            # a page that failed before claiming mustn't hold up the pages after it
+            claims.claim(page_number, [])
+
+def classify_page(cache, messages, provider, claims, page_number):
+    # skip threads the client already answered, before spending any DeepSeek calls on them
+    if provider is not None and REPLY_CHECK_ENABLED:
+        with timed_stage("replies"):
+            messages = drop_answered(cache, provider, messages)
+    # one follow-up per conversation: the latest message per thread, outside the recipient's cooldown
+    messages = collapse(messages)
+    if provider is not None:
+        messages = drop_cooling(cache, provider, messages)
+    # normalise bodies once; both prompts below use the cached text
+    with timed_stage("normalize"):
+        for m in messages:
+            message_text(m)
+    # classify emails as proposals (local pre-filter, then batched DeepSeek requests), reusing verdicts from earlier runs
+    verdicts = cached_classify_many(cache, messages, classify_emails)
+    proposals = [m for m, verdict in zip(messages, verdicts) if verdict]
+    # one follow-up per client per run
+    proposals = one_per_recipient(proposals, claims, page_number)
+    lost = [m for m in proposals if is_lost(m)]
+    open_leads = [m for m in proposals if not is_lost(m)]
+    # generate follow-ups for open leads concurrently
+    if NEAR_DUPLICATE_DRAFTS:
+        # near-duplicate pitches to the same client reuse an earlier draft
+        follow_ups = near_duplicate_drafts(cache, open_leads, [recipient_key(m["to"]) for m in open_leads], generate_follow_ups)
+    else:
+        follow_ups = generate_follow_ups(open_leads)
+    # sympathetic emails for lost leads, follow-ups for the rest
+    outbox = [(m["to"], f"RE: {m['subject']}", SYMPATHETIC_MSG) for m in lost]
+    outbox += [(m["to"], f"RE: {m['subject']}", body) for m, body in zip(open_leads, follow_ups)]
+    return {"proposals": proposals, "lost": lost, "outbox": outbox}
+
+def put(q, item, stop):
+    # put that gives up once the pipeline is stopping
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def get(q, stop):
+    # get that returns DONE once the pipeline is stopping
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return DONE
+
+def start_stage(func, inbox, downstream, workers, stop, errors):
+    # run func on items from inbox with `workers` threads; signal DONE downstream when all finish
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def worker():
+        try:
+            while True:
+                item = get(inbox, stop)
+                if item is DONE:
+                    # let sibling workers see the end of input too
+                    put(inbox, DONE, stop)
+                    break
+                func(item)
+        except Exception as error:
+            # stop every stage and report the first failure
+            errors.append(error)
+            stop.set()
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last and downstream is not None:
+                put(downstream, DONE, stop)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(workers, 1))]
+    remaining[0] = len(threads)
+    for thread in threads:
+        thread.start()
+    return threads
+
+def run_pipeline(provider, cache, today, outbox,
+                 classify_workers=PIPELINE_CLASSIFY_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+    # fetch -> classify -> record -> queue, with bounded queues so the stages overlap;
+    # queued follow-ups are sent by the account's scheduler at its own pace
+    to_classify = queue.Queue(queue_size)
+    to_record = queue.Queue(queue_size)
+    to_send = queue.Queue(queue_size)
+    stop = threading.Event()
+    errors = []
+    fetched = [0]
+    # recipients handled so far in this run, shared by the classify workers
+    claims = RecipientClaims(stop)
+
+    def fetch():
+        try:
+            pages = iter(provider.fetch_pages())
+            page_number = 0
+            while not stop.is_set():
+                # time spent waiting on the provider for the next page
+                with timed_stage("fetch"):
+                    page = next(pages, None)
+                if page is None:
+                    break
+                fetched[0] += len(page)
+                # pages are numbered so recipients are claimed in fetch order
+                put(to_classify, (page_number, page), stop)
+                page_number += 1
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+        finally:
+            put(to_classify, DONE, stop)
+
+    def classify(item):
+        page_number, page = item
+        with timed_stage("classify"):
+            result = process_page(cache, page, provider, claims, page_number)
+        put(to_record, result, stop)
+
+    def record(result):
+        # lead sinks aren't thread-safe, so this stage has a single worker
+        with timed_stage("record"):
+            # upserts: a lead already in the sheet is only touched when its status changes
+            lost_ids = {m["id"] for m in result["lost"]}
+            for m in result["proposals"]:
+                status = "Lost Lead" if m["id"] in lost_ids else "Open Lead"
+                provider.leads.upsert(provider.leads_target, [today, m["to"], m["subject"], status])
+            for m in result["lost"]:
+                provider.leads.upsert(provider.lost_leads_target, [today, m["to"], m["subject"], "Lost Lead"])
+        if result["outbox"]:
+            put(to_send, result["outbox"], stop)
+
+    def send(emails):
+        with timed_stage("send"):
+            enqueue(outbox, provider.name, emails)
+        # a queued follow-up will go out, so the cooldown starts now; this also keeps the
+        # next run from queueing the same recipient while earlier sends are still deferred
+        put_follow_ups(cache, provider.name, [recipient_key(email[0]) for email in emails])
+
+    def deliver():
+        try:
+            scheduler.run(producers_done, stop)
+        except Exception as error:
+            errors.append(error)
+            stop.set()
+
+    scheduler = SendScheduler(outbox, provider.name, provider.send, provider.send_batch_size)
+    producers_done = threading.Event()
+    # starts right away, so follow-ups left queued by an earlier run go out first
+    sender = threading.Thread(target=deliver, daemon=True)
+    sender.start()
+    threads = [threading.Thread(target=fetch, daemon=True)]
+    threads[0].start()
+    threads += start_stage(classify, to_classify, to_record, classify_workers, stop, errors)
+    threads += start_stage(record, to_record, to_send, 1, stop, errors)
+    threads += start_stage(send, to_send, None, 1, stop, errors)
+    for thread in threads:
+        thread.join()
+    producers_done.set()
+    sender.join()
+    if errors:
+        raise errors[0]
+    return fetched[0]
+
+def start_run():
+    # per-run counters shared by every provider (daemon mode runs many in one process)
+    reset_metrics()
+    reset_prefilter_stats()
+    reset_near_duplicate_stats()
+
+def report_run(summary):
+    # what the run skipped and sent, from its metrics summary, and how often local shortcuts avoided DeepSeek
+    skipped = summary['skipped_messages']
+    print(
+        f"Skipped {skipped.get('answered', 0)} answered, {skipped.get('reply_unknown', 0)} unchecked (retried next run), "
+        f"{skipped.get('duplicate', 0)} duplicate and {skipped.get('cooldown', 0)} recently followed-up messages."
+    )
+    sends = summary['sends']
+    print(f"Sent {sends.get('sent', 0)} follow-ups ({sends.get('retried', 0)} retries, {sends.get('failed', 0)} failed).")
+    print(format_prefilter_stats())
+    print(format_near_duplicate_stats())
@@ -0,0 +1,89 @@
+import os
+import re
+import math
+import threading
+
+# scores at or below this are treated as "not a proposal" without asking DeepSeek
+PREFILTER_NEGATIVE_THRESHOLD = float(os.getenv("PREFILTER_NEGATIVE_THRESHOLD", 0.1))
+# scores at or above this are treated as "proposal" without asking DeepSeek
+PREFILTER_POSITIVE_THRESHOLD = float(os.getenv("PREFILTER_POSITIVE_THRESHOLD", 0.95))
+# set to 0 to send every email to DeepSeek
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "1") != "0"
+
+# subject prefixes calendar apps and auto-replies generate ("Invitation: Call @ Mon", "Accepted: ...");
+# the colon keeps pitches like "Invitation to partner with us" out
+NEGATIVE_SUBJECT = re.compile(
+    r"^\s*(accepted|declined|tentative|tentatively accepted|canceled|cancelled|canceled event|cancelled event"
+    r"|updated invitation|invitation|automatic reply|auto-reply|out of office)\s*:",
+    re.IGNORECASE
+)
+# weighted keyword signals; positive weights push towards "proposal"
+SIGNALS = [
+    (re.compile(r"\bproposal\b", re.IGNORECASE), 2.5),
+    (re.compile(r"\b(quote|quotation|estimate|pricing|price list|rates?)\b", re.IGNORECASE), 1.5),
+    (re.compile(r"\b(our services|we offer|we can help|we specialize|partnership|collaborat\w+)\b", re.IGNORECASE), 1.5),
+    (re.compile(r"\b(would you be interested|schedule a (call|demo)|book a (call|demo)|free trial)\b", re.IGNORECASE), 1.5),
+    (re.compile(r"[$€£]\s?\d", re.IGNORECASE), 1.0),
+    (re.compile(r"\b(invitation|calendar|meeting (accepted|declined)|has accepted|has declined)\b", re.IGNORECASE), -2.0),
+    (re.compile(r"\b(unsubscribe|newsletter|receipt|invoice #|password reset)\b", re.IGNORECASE), -2.0),
+    (re.compile(r"^\s*(thanks|thank you|thx|ok|okay|sounds good|got it|great)[!. ]*$", re.IGNORECASE | re.MULTILINE), -1.5),
+]
+# starting bias, and penalty for very short messages; a low score only counts as a confident
+# "not a proposal" when a negative signal fired, since short cover notes for quotes are common
+BIAS = -1.0
+SHORT_BODY_WORDS = 25
+SHORT_BODY_WEIGHT = -2.5
+
+# decisions made during this process, for hit-rate reporting
+stats = {"negative": 0, "positive": 0, "uncertain": 0}
+stats_lock = threading.Lock()
+
+def evaluate(subject, body):
+    # (probability-like score that the email is a proposal, whether a negative signal fired)
+    if NEGATIVE_SUBJECT.search(subject or ""):
+        return 0.0, True
+    total = BIAS
+    negative = False
+    for pattern, weight in SIGNALS:
+        if pattern.search(body) or pattern.search(subject or ""):
+            total += weight
+            negative = negative or weight < 0
+    if len(body.split()) < SHORT_BODY_WORDS:
+        total += SHORT_BODY_WEIGHT
+    return 1 / (1 + math.exp(-total)), negative
+
+def score(subject, body):
+    # probability-like score that the email is a proposal
+    return evaluate(subject, body)[0]
+
+def prefilter(subject, body):
+    # return True/False for confident local decisions, None if DeepSeek should decide
+    verdict = None
+    outcome = "uncertain"
+    if PREFILTER_ENABLED:
+        value, negative = evaluate(subject, body)
+        if value <= PREFILTER_NEGATIVE_THRESHOLD and negative:
+            verdict, outcome = False, "negative"
+        elif value >= PREFILTER_POSITIVE_THRESHOLD:
+            verdict, outcome = True, "positive"
+    # pipeline workers classify pages in parallel
+    with stats_lock:
+        stats[outcome] += 1
+    return verdict
+
+def reset_stats():
+    # start counting a new run (daemon mode runs many in one process)
+    with stats_lock:
+        for key in stats:
+            stats[key] = 0
+
+def format_stats():
+    # summary of how many emails were decided locally
+    total = sum(stats.values())
+    if not total:
+        return "Pre-filter: no emails scored."
+    local = stats["negative"] + stats["positive"]
+    return (
+        f"Pre-filter: {local}/{total} decided locally ({local / total:.0%} hit rate; "
+        f"{stats['negative']} negative, {stats['positive']} positive), {stats['uncertain']} sent to DeepSeek."
+    )
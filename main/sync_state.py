@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import sqlite3
+
+# SQLite file holding sync cursors and the messages tracked between runs
+SYNC_STATE_DB = os.getenv("SYNC_STATE_DB", "sync_state.db")
+# set to 1 to fetch only messages added since the last run
+INCREMENTAL_SYNC = os.getenv("INCREMENTAL_SYNC", "0") == "1"
+# tracked messages older than this are dropped (default 8 days, just past the 2-7 day window)
+TRACKED_RETENTION_SECONDS = int(os.getenv("TRACKED_RETENTION_SECONDS", 8 * 24 * 3600))
+
+def open_sync_state(path=SYNC_STATE_DB):
+    # open (or create) the sync state database; it is read from the pipeline's fetch thread,
+    # and mailboxes synced in parallel each hold a connection, so wait for their write locks
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS cursors ("
+        " provider TEXT PRIMARY KEY,"
+        " cursor TEXT NOT NULL,"
+        " updated_at REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tracked_messages ("
+        " provider TEXT NOT NULL,"
+        " message_id TEXT NOT NULL,"
+        " sent_at REAL NOT NULL,"
+        " data TEXT NOT NULL,"
+        " PRIMARY KEY (provider, message_id))"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS tracked_messages_sent_at ON tracked_messages (provider, sent_at)")
+    # forget messages that have left the follow-up window
+    conn.execute("DELETE FROM tracked_messages WHERE sent_at < ?", (time.time() - TRACKED_RETENTION_SECONDS,))
+    conn.commit()
+    return conn
+
+def get_cursor(conn, provider):
+    # return the saved Gmail historyId / Graph deltaLink, or None before the first sync
+    row = conn.execute("SELECT cursor FROM cursors WHERE provider = ?", (provider,)).fetchone()
+    return row[0] if row else None
+
+def set_cursor(conn, provider, cursor):
+    # save the cursor to resume from on the next run
+    conn.execute(
+        "INSERT OR REPLACE INTO cursors (provider, cursor, updated_at) VALUES (?, ?, ?)",
+        (provider, cursor, time.time())
+    )
+    conn.commit()
+
+def track_messages(conn, provider, messages):
+    # merge (message_id, sent_at, data) tuples into the local store
+    conn.executemany(
+        "INSERT OR REPLACE INTO tracked_messages (provider, message_id, sent_at, data) VALUES (?, ?, ?, ?)",
+        [(provider, message_id, sent_at, json.dumps(data)) for message_id, sent_at, data in messages]
+    )
+    conn.commit()
+
+def untrack_messages(conn, provider, message_ids):
+    # drop messages that were deleted from the mailbox
+    conn.executemany(
+        "DELETE FROM tracked_messages WHERE provider = ? AND message_id = ?",
+        [(provider, message_id) for message_id in message_ids]
+    )
+    conn.commit()
+
+def tracked_in_window(conn, provider, since, until):
+    # yield stored messages sent between the two epoch timestamps, newest first (like the mailbox listings)
+    rows = conn.execute(
+        "SELECT data FROM tracked_messages WHERE provider = ? AND sent_at >= ? AND sent_at <= ? ORDER BY sent_at DESC",
+        (provider, since, until)
+    )
+    for (data,) in rows:
+        yield json.loads(data)
@@ -0,0 +1,17 @@
+import hashlib
+
+def chunked(iterable, size):
+    # group an iterable into lists of at most `size` items
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def shard_owner(key, shards):
+    # rendezvous (highest random weight) hashing: the shard that owns `key`;
+    # changing the shard count only moves the keys of the added or removed shard
+    return max(range(shards), key=lambda shard: hashlib.sha1(f"{shard}:{key}".encode("utf-8")).digest())
@@ -0,0 +1,511 @@
+# Offline benchmark: runs follow_up_logic / follow_up_logic_outlook against local fake
+# Gmail, Sheets, Graph and DeepSeek servers and reports throughput, latency and API call counts.
+#
+#   python test_files/benchmark.py --provider both --sizes 10 100 1000 10000 --latency 0.02 --error-rate 0.01
+#
+# Concurrency settings are read from the environment, e.g.
+#   DEEPSEEK_MAX_IN_FLIGHT=16 PIPELINE_CLASSIFY_WORKERS=4 python test_files/benchmark.py
+
+import os
+import re
+import io
+import sys
+import json
+import time
+import base64
+import random
+import argparse
+import tempfile
+import threading
+import contextlib
+import email
+import tracemalloc
+import multiprocessing
+import urllib.parse
+import urllib.request
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MAIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "main")
+
+PITCH = (
+    "Hi {name},\n\nFollowing our call, please find below our proposal for the website redesign. "
+    "Our pricing starts at $4,000 and includes three rounds of revisions. We can start next month. "
+    "Would you be interested in a short call to go through the details?\n\nBest regards,\nSam"
+)
+CHATTER = "Hi {name},\n\nThanks for lunch yesterday, see you at the team offsite next week.\n\nSam"
+LOST = "Hi {name},\n\nNoted on our proposal - you wrote \"we went with another company\" for the redesign. Thanks for considering us.\n\nSam"
+# signature, disclaimer and quoted history, as real replies carry them
+FOOTER = (
+    "\n\n--\nSam Carter | Carter Studio\n+1 555 0100 | carter.example.com\n\n"
+    "CONFIDENTIALITY NOTICE: This email and any attachments are for the sole use of the intended recipient. "
+    "If you received it in error, please notify the sender and delete it.\n\n"
+    "On Mon, 1 Jan 2024 at 09:00, {name} <{name}@example.com> wrote:\n"
+    + "> Thanks for the call today, we are still comparing a few studios and will get back to you soon.\n" * 12
+)
+
+class FakeState:
+    # mailbox contents and per-endpoint counters shared by the handler threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset({})
+
+    def reset(self, config):
+        with self.lock:
+            self.size = int(config.get("size", 10))
+            self.latency = float(config.get("latency", 0))
+            self.error_rate = float(config.get("error_rate", 0))
+            self.proposal_ratio = float(config.get("proposal_ratio", 0.5))
+            self.reply_ratio = float(config.get("reply_ratio", 0.2))
+            self.messages_per_client = int(config.get("messages_per_client", 1))
+            self.mailboxes = int(config.get("mailboxes", 1))
+            self.random = random.Random(config.get("seed", 1))
+            self.calls = Counter()
+            self.fetched_at = {}
+            self.sent_at = {}
+            # follow-ups whose body greets a different client than the one they went to
+            self.misaddressed = []
+            # rows appended to each fake spreadsheet, after the header
+            self.sheets = {}
+
+    def client(self, i):
+        # each client gets messages_per_client consecutive messages, all in one thread
+        return i // self.messages_per_client
+
+    def thread_messages(self, c):
+        # indexes of the messages in client c's thread
+        start = c * self.messages_per_client
+        return range(start, min(start + self.messages_per_client, self.size))
+
+    def mailbox_messages(self, user):
+        # message indexes in a mailbox: everything for /me, otherwise the clients of user uK
+        if user is None:
+            return range(self.size)
+        k = int(user[1:])
+        return [i for i in range(self.size) if self.client(i) % self.mailboxes == k]
+
+    def message(self, i):
+        # deterministic message i; sends are matched back to it by recipient
+        c = self.client(i)
+        name = f"client{c}"
+        kind = c % 20
+        if kind == 0:
+            template = LOST
+        elif kind / 20 < self.proposal_ratio:
+            template = PITCH
+        else:
+            template = CHATTER
+        return {
+            "id": f"m{i}",
+            "thread_id": f"t{c}",
+            "to": f"{name}@example.com",
+            "subject": f"Website redesign {i}",
+            "body": (template + FOOTER).format(name=name),
+            "sent": "2024-01-01T00:00:00Z"
+        }
+
+    def replied(self, c):
+        # whether client c already answered the thread (spread evenly over the mailbox)
+        return (c * 37) % 100 < self.reply_ratio * 100
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def fail(self):
+        # randomly inject a throttling error
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def mark_fetched(self, i):
+        with self.lock:
+            self.fetched_at.setdefault(f"client{self.client(i)}@example.com", time.time())
+
+    def mark_sent(self, to, body):
+        greeted = re.search(r"\bHi (client\d+),", body)
+        with self.lock:
+            self.sent_at.setdefault(to, time.time())
+            if greeted and f"{greeted.group(1)}@example.com" != to:
+                self.misaddressed.append(to)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(
+                self.sent_at[to] - self.fetched_at[to] for to in self.sent_at if to in self.fetched_at
+            )
+            return {"calls": dict(self.calls), "latencies": latencies, "misaddressed": len(self.misaddressed)}
+
+def gmail_resource(state, i, fmt):
+    m = state.message(i)
+    headers = [{"name": "Subject", "value": m["subject"]}, {"name": "To", "value": m["to"]}]
+    resource = {"id": m["id"], "threadId": m["thread_id"], "internalDate": "1704067200000", "payload": {"headers": headers}}
+    if fmt == "full":
+        state.mark_fetched(i)
+        # multipart/mixed > multipart/alternative > text/plain + text/html, as mail clients send it
+        encode = lambda text: {"data": base64.urlsafe_b64encode(text.encode()).decode()}
+        html = "<html><body>" + "".join(f"<p>{line}</p>" for line in m["body"].split("\n")) + "</body></html>"
+        resource["payload"]["mimeType"] = "multipart/mixed"
+        resource["payload"]["parts"] = [{
+            "mimeType": "multipart/alternative",
+            "parts": [
+                {"mimeType": "text/plain", "body": encode(m["body"])},
+                {"mimeType": "text/html", "body": encode(html)}
+            ]
+        }]
+    return resource
+
+def gmail_thread(state, c):
+    # our sent messages, plus the client's reply an hour later for answered threads
+    messages = [{"id": f"m{i}", "internalDate": "1704067200000", "labelIds": ["SENT"]} for i in state.thread_messages(c)]
+    if state.replied(c):
+        messages.append({"id": f"r{c}", "internalDate": "1704070800000", "labelIds": ["INBOX", "UNREAD"]})
+    return {"id": f"t{c}", "messages": messages}
+
+def graph_conversation(state, c):
+    sender = {"emailAddress": {"address": "sam@studio.example"}}
+    messages = [{"id": f"m{i}", "from": sender, "receivedDateTime": "2024-01-01T00:00:00Z", "isDraft": False} for i in state.thread_messages(c)]
+    if state.replied(c):
+        messages.append({"id": f"r{c}", "from": {"emailAddress": {"address": f"client{c}@example.com"}}, "receivedDateTime": "2024-01-01T01:00:00Z", "isDraft": False})
+    return {"value": messages}
+
+def graph_resource(state, i):
+    m = state.message(i)
+    state.mark_fetched(i)
+    return {
+        "id": m["id"],
+        "conversationId": m["thread_id"],
+        "subject": m["subject"],
+        "sentDateTime": m["sent"],
+        "toRecipients": [{"emailAddress": {"address": m["to"]}}],
+        "body": {"contentType": "text", "content": m["body"]}
+    }
+
+def deepseek_reply(prompt):
+    # answer the prompts the app sends: batched JSON verdicts, Yes/No, or a follow-up draft
+    if prompt.startswith("For each email below"):
+        verdicts = []
+        for email_id, text in re.findall(r"### Email id (\d+)\n(.*?)(?=\n### Email id |\Z)", prompt, re.DOTALL):
+            verdicts.append({"id": email_id, "proposal": "proposal" in text})
+        return json.dumps(verdicts)
+    if prompt.startswith("Is the following email"):
+        return "Yes" if "proposal" in prompt.split("\n\n", 1)[-1] else "No"
+    # drafts greet the client by name, as real ones do, so a draft sent to the wrong client shows up
+    greeted = re.search(r"\bHi (\w+),", prompt)
+    name = f" {greeted.group(1)}" if greeted else ""
+    return f"Hi{name}, just checking in on the proposal I sent last week. Happy to answer any questions."
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes; without this, delayed ACKs add ~40ms per call
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, *args):
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length) if length else b""
+
+    def reply(self, status, payload, headers=None, content_type="application/json"):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def base_url(self):
+        return f"http://{self.headers['Host']}"
+
+    def do_GET(self):
+        self.handle_request("GET", self.read_body())
+
+    def do_POST(self):
+        self.handle_request("POST", self.read_body())
+
+    def handle_request(self, method, body):
+        state = self.state
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path == "/__stats":
+            return self.reply(200, state.stats())
+        if url.path == "/__reset":
+            state.reset(json.loads(body))
+            return self.reply(200, {})
+        if state.latency:
+            time.sleep(state.latency)
+
+        if url.path == "/deepseek/v1/chat/completions":
+            state.count("deepseek")
+            if state.fail():
+                return self.reply(429, {"error": "rate limited"}, {"Retry-After": "0"})
+            prompt = json.loads(body)["messages"][0]["content"]
+            content = deepseek_reply(prompt)
+            usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            return self.reply(200, {"choices": [{"message": {"content": content}}], "usage": usage})
+
+        if url.path in ("/batch", "/batch/gmail/v1"):
+            state.count("gmail.batch")
+            return self.gmail_batch(body)
+        if url.path == "/gmail/v1/users/me/messages":
+            state.count("gmail.messages.list")
+            start = int(query.get("pageToken", ["0"])[0])
+            page_size = int(query.get("maxResults", ["100"])[0])
+            end = min(start + page_size, state.size)
+            page = {"messages": [{"id": f"m{i}"} for i in range(start, end)]}
+            if end < state.size:
+                page["nextPageToken"] = str(end)
+            return self.reply(200, page)
+        match = re.fullmatch(r"/gmail/v1/users/me/messages/m(\d+)", url.path)
+        if match:
+            state.count("gmail.messages.get")
+            return self.reply(200, gmail_resource(state, int(match.group(1)), query.get("format", ["full"])[0]))
+        if url.path == "/gmail/v1/users/me/messages/send":
+            state.count("gmail.messages.send")
+            sent = email.message_from_bytes(base64.urlsafe_b64decode(json.loads(body)["raw"]))
+            state.mark_sent(sent["to"].strip(), sent.get_payload(decode=True).decode())
+            return self.reply(200, {"id": f"s{time.time_ns()}"})
+        if url.path.startswith("/v4/spreadsheets/"):
+            sheet_id = url.path.split("/")[3]
+            if method == "GET":
+                state.count("sheets.get")
+                with state.lock:
+                    rows = list(state.sheets.get(sheet_id, []))
+                return self.reply(200, {"values": [["Date", "Client", "Subject", "Status"]] + rows})
+            if url.path.endswith(":batchUpdate"):
+                state.count("sheets.batchUpdate")
+                return self.reply(200, {})
+            state.count("sheets.append")
+            if state.fail():
+                return self.reply(429, {"error": {"code": 429, "message": "quota"}})
+            with state.lock:
+                rows = state.sheets.setdefault(sheet_id, [])
+                first = len(rows) + 2
+                rows.extend(json.loads(body)["values"])
+                last = len(rows) + 1
+            return self.reply(200, {"updates": {"updatedRange": f"Sheet1!A{first}:D{last}"}})
+
+        match = re.fullmatch(r"/graph/(me|users/([^/]+))/mailFolders/sentitems/messages", url.path)
+        if match:
+            state.count("graph.messages.list")
+            indexes = state.mailbox_messages(match.group(2))
+            skip = int(query.get("$skip", ["0"])[0])
+            top = int(query.get("$top", ["50"])[0])
+            end = min(skip + top, len(indexes))
+            page = {"value": [graph_resource(state, i) for i in indexes[skip:end]]}
+            if end < len(indexes):
+                page["@odata.nextLink"] = f"{self.base_url()}{url.path}?$skip={end}&$top={top}"
+            return self.reply(200, page)
+        if re.fullmatch(r"/graph/(me|users/[^/]+)/sendMail", url.path):
+            state.count("graph.sendMail")
+            message = json.loads(body)["message"]
+            state.mark_sent(message["toRecipients"][0]["emailAddress"]["address"], message["body"]["content"])
+            return self.reply(202, b"")
+        if url.path == "/graph/$batch":
+            state.count("graph.batch")
+            responses = []
+            for item in json.loads(body)["requests"]:
+                state.count("graph.batch.item")
+                if state.fail():
+                    responses.append({"id": item["id"], "status": 429, "headers": {"Retry-After": "0"}})
+                    continue
+                if item["method"] == "GET":
+                    # conversation lookup: /me/messages?$filter=conversationId eq 'tN'
+                    index = int(re.search(r"conversationId eq 't(\d+)'", urllib.parse.unquote(item["url"])).group(1))
+                    responses.append({"id": item["id"], "status": 200, "body": graph_conversation(state, index)})
+                    continue
+                message = item["body"]["message"]
+                state.mark_sent(message["toRecipients"][0]["emailAddress"]["address"], message["body"]["content"])
+                responses.append({"id": item["id"], "status": 202})
+            return self.reply(200, {"responses": responses})
+
+        return self.reply(404, {"error": f"no fake for {method} {url.path}"})
+
+    def gmail_batch(self, body):
+        # answer a multipart/mixed batch of messages.get / threads.get calls
+        boundary = re.search(r'boundary="?([^";]+)"?', self.headers["Content-Type"]).group(1)
+        parts = []
+        for part in body.decode().split(f"--{boundary}"):
+            content_id = re.search(r"Content-ID: <(.+)>", part, re.IGNORECASE)
+            request_line = re.search(r"^GET (\S+) HTTP/1.1", part, re.MULTILINE)
+            if not content_id or not request_line:
+                continue
+            self.state.count("gmail.batch.item")
+            if self.state.fail():
+                # Gmail throttles single batch items with a rate-limit 403
+                error = {"error": {"code": 403, "errors": [{"reason": "userRateLimitExceeded"}]}}
+                parts.append(
+                    f"--batch_response\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id.group(1)}>\r\n\r\n"
+                    f"HTTP/1.1 403 Forbidden\r\nContent-Type: application/json\r\n\r\n{json.dumps(error)}\r\n"
+                )
+                continue
+            url = urllib.parse.urlsplit(request_line.group(1))
+            kind, index = re.search(r"/(messages|threads)/[mt](\d+)$", url.path).groups()
+            if kind == "threads":
+                payload = json.dumps(gmail_thread(self.state, int(index)))
+            else:
+                fmt = urllib.parse.parse_qs(url.query).get("format", ["full"])[0]
+                payload = json.dumps(gmail_resource(self.state, int(index), fmt))
+            parts.append(
+                f"--batch_response\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id.group(1)}>\r\n\r\n"
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{payload}\r\n"
+            )
+        data = ("".join(parts) + "--batch_response--\r\n").encode()
+        self.reply(200, data, content_type="multipart/mixed; boundary=batch_response")
+
+def serve(port_queue):
+    # run the fake servers in a child process so they don't skew the app's timings or memory
+    Handler.state = FakeState()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def call_fake(base_url, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    request = urllib.request.Request(base_url + path, data=data, method="POST" if data else "GET")
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+def gmail_services(base_url):
+    # build Gmail and Sheets clients from the bundled discovery documents, pointed at the fake server
+    import httplib2
+    from googleapiclient.discovery import build_from_document
+    from googleapiclient.discovery_cache import get_static_doc
+    from googleapiclient.http import HttpRequest
+    local = threading.local()
+
+    def build_request(http, *args, **kwargs):
+        if not hasattr(local, "http"):
+            local.http = httplib2.Http()
+        return HttpRequest(local.http, *args, **kwargs)
+
+    services = []
+    for name, version in (("gmail", "v1"), ("sheets", "v4")):
+        doc = json.loads(get_static_doc(name, version))
+        doc["rootUrl"] = base_url + "/"
+        services.append(build_from_document(doc, http=httplib2.Http(), requestBuilder=build_request))
+    return services
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def run_once(provider, size, args, base_url):
+    import metrics
+    import prefilter
+    import main as gmail_main
+    import main_outlook
+
+    call_fake(base_url, "/__reset", {
+        "size": size,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "proposal_ratio": args.proposal_ratio,
+        "reply_ratio": args.reply_ratio,
+        "messages_per_client": args.messages_per_client,
+        "mailboxes": args.mailboxes,
+        "seed": args.seed
+    })
+    for key in prefilter.stats:
+        prefilter.stats[key] = 0
+    workdir = tempfile.mkdtemp(prefix="email-automator-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        # keep per-email prints out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            if provider == "gmail":
+                gmail_service, sheets_service = gmail_services(base_url)
+                gmail_main.follow_up_logic(gmail_service, sheets_service, incremental=False)
+            else:
+                # more than one mailbox runs the app-only multi-mailbox mode (/users/uK)
+                mailboxes = [f"u{k}" for k in range(args.mailboxes)] if args.mailboxes > 1 else None
+                main_outlook.follow_up_logic_outlook("fake-token", incremental=False, mailboxes=mailboxes)
+        elapsed = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        # the app's own run summary (written by follow_up_logic)
+        app_metrics = metrics.summary()
+    finally:
+        tracemalloc.stop()
+        os.chdir(cwd)
+    stats = call_fake(base_url, "/__stats")
+    return {
+        "provider": provider,
+        "messages": size,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(size / elapsed, 1) if elapsed else None,
+        "p50_latency_seconds": round(percentile(stats["latencies"], 0.5), 3),
+        "p99_latency_seconds": round(percentile(stats["latencies"], 0.99), 3),
+        "peak_memory_mb": round(peak / 1e6, 2),
+        "api_calls": stats["calls"],
+        "deepseek_tokens": app_metrics["deepseek_tokens"]["total_tokens"],
+        "skipped_messages": app_metrics["skipped_messages"],
+        "sends": app_metrics["sends"],
+        "misaddressed_sends": stats["misaddressed"],
+        "stage_seconds": {name: round(stage["seconds"], 3) for name, stage in app_metrics["stages"].items()}
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark for the follow-up pipeline.")
+    parser.add_argument("--provider", choices=["gmail", "outlook", "both"], default="both")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every fake API call")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of DeepSeek/Sheets/Graph/Gmail batch calls throttled with 429 (403 for Gmail)")
+    parser.add_argument("--proposal-ratio", type=float, default=0.5, help="fraction of the mailbox that is proposals")
+    parser.add_argument("--reply-ratio", type=float, default=0.2, help="fraction of threads the client already answered")
+    parser.add_argument("--messages-per-client", type=int, default=1, help="sent messages per client thread in the window")
+    parser.add_argument("--mailboxes", type=int, default=1, help="Outlook only: split the fake mailbox across this many users")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args()
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(port_queue,), daemon=True)
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}"
+
+    # point the app at the fakes before its modules read their settings
+    os.environ["DEEPSEEK_API_URL"] = f"{base_url}/deepseek/v1/chat/completions"
+    os.environ["GRAPH_API_URL"] = f"{base_url}/graph"
+    os.environ.setdefault("DEEPSEEK_API_KEY", "fake-key")
+    # measure the pipeline rather than the production rate limit, unless asked to
+    os.environ.setdefault("DEEPSEEK_RATE_PER_SECOND", "1000000")
+    os.environ.setdefault("DEEPSEEK_BURST", "1000000")
+    os.environ.setdefault("DEEPSEEK_BACKOFF_BASE", "0.01")
+    os.environ.setdefault("GRAPH_MAILBOX_RATE_PER_SECOND", "1000000")
+    os.environ.setdefault("GRAPH_MAILBOX_BURST", "1000000")
+    os.environ.setdefault("SEND_RATE_PER_MINUTE", "60000000")
+    os.environ.setdefault("SEND_DAILY_QUOTA", "1000000")
+    os.environ.setdefault("SEND_BACKOFF_BASE", "0.01")
+    sys.path.insert(0, MAIN_DIR)
+
+    providers = ["gmail", "outlook"] if args.provider == "both" else [args.provider]
+    results = []
+    print(f"{'provider':<8} {'msgs':>6} {'secs':>8} {'msg/s':>8} {'p50 s':>7} {'p99 s':>7} {'peak MB':>8} {'tokens':>8}  api calls")
+    for provider in providers:
+        for size in args.sizes:
+            result = run_once(provider, size, args, base_url)
+            results.append(result)
+            calls = ", ".join(f"{name}={count}" for name, count in sorted(result["api_calls"].items()))
+            print(
+                f"{provider:<8} {size:>6} {result['seconds']:>8} {result['messages_per_second']:>8} "
+                f"{result['p50_latency_seconds']:>7} {result['p99_latency_seconds']:>7} {result['peak_memory_mb']:>8} "
+                f"{result['deepseek_tokens']:>8}  {calls}"
+            )
+            if result["misaddressed_sends"]:
+                print(f"⚠️ {result['misaddressed_sends']} follow-ups greeted a different client than their recipient")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    server.terminate()
+
+if __name__ == "__main__":
+    main()